@@ -0,0 +1,228 @@
+""" Benchmark the food classifier prediction paths on CPU.
+
+Both paths the app uses are timed on photos of a generated benchmark user
+(see `benchmarks/generate_data.py`), or on the photos given with
+`--photo-ids`:
+
+* `food101`: `dbutils.predict_food_name_from_photo`, behind
+  `/photos/<id>/food_predictions`. One photo at a time, broken down into
+  fetching the photo and evaluating the food101 checkpoint.
+* `resnet`: the batched forward pass in `dbutils.classify_photo_groups`, used
+  when food entries are autogenerated from photos. Broken down into fetch,
+  decoding, preprocessing, the forward pass and post-processing. It is run
+  with the float model and with torchvision's statically quantized (int8)
+  ResNet-18, in which the convolutions are quantized as well as the final
+  fully-connected layer.
+
+Photos are fetched the way the app fetches them. With `--fetch disk` they are
+read from `UPLOAD_FOLDER`. With `--fetch s3` they are downloaded from
+`LOGS_PHOTO_BUCKET_NAME` into an empty temporary folder on every iteration,
+so they must be photos that were uploaded through the app.
+
+One JSON object is written per configuration so results can be compared
+across runs.
+
+Usage:
+    python benchmarks/classifier.py --batch-sizes 1,4,16 --threads 1,2,4 --output results.jsonl
+    python benchmarks/classifier.py --photo-ids 12,13,14 --fetch s3 --paths food101
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+import torch
+import torchvision
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fitnessapp import app
+from fitnessapp.extensions import db
+from fitnessapp import dbutils
+from fitnessapp.ml import image_classifier
+import tracker_data.food101.train
+from tracker_database import User, Photo
+
+RESNET_STAGES = ['fetch', 'decode', 'preprocess', 'forward', 'postprocess', 'total']
+FOOD101_STAGES = ['fetch', 'predict', 'total']
+
+def get_photos(args):
+    if args.photo_ids is not None:
+        photos = db.session.query(Photo) \
+                .filter(Photo.id.in_(args.photo_ids)) \
+                .all()
+    else:
+        user = db.session.query(User).filter_by(email=args.email).first()
+        if user is None:
+            raise SystemExit('No user %s. Run benchmarks/generate_data.py first.' % args.email)
+        photos = db.session.query(Photo) \
+                .filter_by(user_id=user.id) \
+                .order_by(Photo.id.desc()) \
+                .limit(args.num_photos) \
+                .all()
+    if len(photos) == 0:
+        raise SystemExit('No photos found.')
+    return photos
+
+def get_resnet(quantized):
+    if not quantized:
+        return image_classifier.get_model()
+    # Weights and activations are int8 throughout, using fbgemm kernels on x86
+    model = torchvision.models.quantization.resnet18(pretrained=True, quantize=True)
+    model.eval()
+    return model
+
+def clear_downloads(fetch):
+    """ Empty the download folder when fetching from S3, so every iteration downloads its photos again. Not timed. """
+    if fetch != 's3':
+        return
+    folder = app.config['UPLOAD_FOLDER']
+    for file_name in os.listdir(folder):
+        os.remove(os.path.join(folder, file_name))
+
+def run_food101(photo):
+    """ Run `dbutils.predict_food_name_from_photo` once and return the time spent in each stage. """
+    t0 = time.perf_counter()
+    file_name = dbutils.get_photo_file_name(photo.id, size=700)
+    t1 = time.perf_counter()
+    tracker_data.food101.train.evaluate_image(dbutils.FOOD101_CHECKPOINT, file_name)
+    t2 = time.perf_counter()
+    return {
+        'fetch': t1-t0,
+        'predict': t2-t1,
+        'total': t2-t0
+    }
+
+def run_resnet(model, photos):
+    """ Run the prediction path of `dbutils.classify_photo_groups` once on a batch of photos and return the time spent in each stage. """
+    t0 = time.perf_counter()
+    file_names = [dbutils.get_local_photo_file_name(p, size=700) for p in photos]
+    t1 = time.perf_counter()
+    images = []
+    for file_name in file_names:
+        img = Image.open(file_name)
+        img.load()
+        images.append(img)
+    t2 = time.perf_counter()
+    batch = torch.stack([image_classifier.preprocess(img) for img in images])
+    t3 = time.perf_counter()
+    with torch.no_grad():
+        scores = model(batch).numpy()
+    t4 = time.perf_counter()
+    [image_classifier.scores_to_food_name(s) for s in scores]
+    t5 = time.perf_counter()
+    return {
+        'fetch': t1-t0,
+        'decode': t2-t1,
+        'preprocess': t3-t2,
+        'forward': t4-t3,
+        'postprocess': t5-t4,
+        'total': t5-t0
+    }
+
+def percentiles(values):
+    values = np.array(values)*1000
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'mean_ms': float(values.mean())
+    }
+
+def benchmark(run, batches, stages, fetch, warmup):
+    """ Call `run` on each batch of photos and summarize the timings of the batches after the first `warmup`. """
+    timings = []
+    for i, batch in enumerate(batches):
+        clear_downloads(fetch)
+        t = run(batch)
+        if i >= warmup:
+            timings.append(t)
+    total_time = sum(t['total'] for t in timings)
+    return {
+        'iterations': len(timings),
+        'latency': dict([
+            (stage, percentiles([t[stage] for t in timings]))
+            for stage in stages
+        ]),
+        'images_per_second': len(batches[0])*len(timings)/total_time,
+        # ru_maxrss is in kilobytes on Linux. It is the peak for the whole
+        # process, so it never decreases from one configuration to the next.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    }
+
+def make_batches(photos, batch_size, count):
+    return [
+        [photos[(i*batch_size+j) % len(photos)] for j in range(batch_size)]
+        for i in range(count)
+    ]
+
+def parse_int_list(value):
+    return [int(x) for x in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the food classifiers on CPU.')
+    parser.add_argument('--email', default='benchmark-0@example.com', help='User whose photos are classified.')
+    parser.add_argument('--photo-ids', type=parse_int_list, default=None, help='Comma-separated photo IDs to classify instead.')
+    parser.add_argument('--num-photos', type=int, default=32)
+    parser.add_argument('--fetch', default='disk', choices=['disk', 's3'])
+    parser.add_argument('--paths', default='food101,resnet', help='Comma-separated list of `food101` and/or `resnet`.')
+    parser.add_argument('--batch-sizes', type=parse_int_list, default=[1,4,16], help='Batch sizes for the resnet path. food101 classifies one photo at a time.')
+    parser.add_argument('--threads', type=parse_int_list, default=[1,2,4])
+    parser.add_argument('--models', default='float,quantized', help='Comma-separated list of `float` and/or `quantized` models for the resnet path.')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', default=None, help='File to append JSON lines to. Defaults to stdout.')
+    args = parser.parse_args()
+    paths = args.paths.split(',')
+
+    metadata = {
+        'benchmark': 'classifier',
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'torch_version': torch.__version__,
+        'fetch': args.fetch
+    }
+    output = sys.stdout if args.output is None else open(args.output, 'a')
+    def report(result):
+        result.update(metadata)
+        output.write(json.dumps(result)+'\n')
+        output.flush()
+
+    download_folder = None
+    if args.fetch == 's3':
+        # Never touch the real upload folder
+        download_folder = tempfile.mkdtemp()
+        app.config['UPLOAD_FOLDER'] = download_folder
+    count = args.warmup+args.iterations
+    try:
+        with app.app_context():
+            photos = get_photos(args)
+            for threads in args.threads:
+                torch.set_num_threads(threads)
+                if 'food101' in paths:
+                    result = benchmark(lambda batch: run_food101(batch[0]),
+                            make_batches(photos, 1, count), FOOD101_STAGES, args.fetch, args.warmup)
+                    report(dict(result, path='food101', model='float', batch_size=1, threads=threads))
+                if 'resnet' not in paths:
+                    continue
+                for model_type in args.models.split(','):
+                    model = get_resnet(quantized=(model_type == 'quantized'))
+                    for batch_size in args.batch_sizes:
+                        result = benchmark(lambda batch: run_resnet(model, batch),
+                                make_batches(photos, batch_size, count), RESNET_STAGES, args.fetch, args.warmup)
+                        report(dict(result, path='resnet', model=model_type, batch_size=batch_size, threads=threads))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if download_folder is not None:
+            shutil.rmtree(download_folder)
+
+if __name__ == '__main__':
+    main()
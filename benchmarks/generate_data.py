@@ -0,0 +1,284 @@
+""" Fill a local database with synthetic users for benchmarking.
+
+Each user gets a history of `--days` days ending today, made of:
+- meals (parent food entries) with nested items, some of them with photos,
+- bodyweight entries,
+- workout sessions of sets grouped under a parent set,
+- a tree of tags.
+
+Photos are written as `<id>-32` and `<id>-700` files in `UPLOAD_FOLDER`,
+which is where the app looks before going to S3. Users log in with
+`<prefix>-<n>@example.com` and the password given by `--password`.
+
+Only runs against a database on localhost.
+
+Usage:
+    python benchmarks/generate_data.py --users 10 --days 365
+    python benchmarks/generate_data.py --users 200 --days 1000 --meals-per-day 4
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+import bcrypt
+import numpy as np
+from PIL import Image
+from sqlalchemy import String
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fitnessapp import app
+from fitnessapp.extensions import db
+from fitnessapp import tag_tree, workout_rollups, bodyweight_stats
+from tracker_database import User, UserProfile, WeightUnitsEnum, Food, Photo, Bodyweight, WorkoutSet, Exercise, Tag
+
+LOCAL_HOSTS = (None, '', 'localhost', '127.0.0.1', '::1')
+
+# (name, quantity, calories, protein)
+FOODS = [
+    ('Oatmeal', '1 cup', 150, 5), ('Banana', '1', 105, 1.3), ('Milk', '250 ml', 122, 8),
+    ('Coffee', '1 cup', 2, 0.3), ('Egg', '1', 78, 6), ('Toast', '1 slice', 75, 2.6),
+    ('Butter', '1 tbsp', 102, 0.1), ('Orange juice', '250 ml', 112, 1.7), ('Yogurt', '175 g', 150, 9),
+    ('Granola', '0.5 cup', 300, 7), ('Apple', '1', 95, 0.5), ('Chicken breast', '150 g', 248, 46),
+    ('Rice', '1 cup', 206, 4.3), ('Broccoli', '1 cup', 31, 2.5), ('Salad', '2 cups', 20, 1.5),
+    ('Olive oil', '1 tbsp', 119, 0), ('Pasta', '1 cup', 221, 8), ('Tomato sauce', '0.5 cup', 45, 2),
+    ('Ground beef', '100 g', 250, 26), ('Cheddar', '30 g', 120, 7), ('Sandwich bread', '2 slices', 160, 6),
+    ('Ham', '50 g', 73, 9), ('Peanut butter', '2 tbsp', 190, 8), ('Salmon', '150 g', 312, 34),
+    ('Potato', '1', 163, 4.3), ('Tofu', '150 g', 144, 15), ('Black beans', '0.5 cup', 114, 7.6),
+    ('Tortilla', '1', 140, 4), ('Avocado', '0.5', 120, 1.5), ('Pizza', '1 slice', 285, 12),
+    ('Chocolate', '40 g', 216, 3), ('Almonds', '28 g', 164, 6), ('Protein shake', '1 scoop', 120, 24),
+    ('Soup', '1 bowl', 180, 8), ('Ramen', '1 bowl', 450, 14), ('Sushi', '6 pieces', 300, 12),
+]
+MEALS = ['Breakfast', 'Lunch', 'Dinner', 'Snack']
+EXERCISES = ['Squat', 'Bench press', 'Deadlift', 'Overhead press', 'Pull up', 'Push up', 'Plank', 'Running']
+TAGS = {
+    'Food': ['Fruit', 'Vegetable', 'Meat', 'Dairy', 'Grain'],
+    'Drink': ['Coffee', 'Juice', 'Water'],
+    'Dessert': ['Chocolate', 'Cake'],
+}
+
+def check_local_database():
+    url = db.engine.url
+    if url.host not in LOCAL_HOSTS:
+        raise SystemExit('Refusing to generate data in a database on %s. Only local databases are allowed.' % url.host)
+
+def insert_returning_ids(table, rows, batch_size):
+    """ Insert rows with multi-row INSERT statements and return their IDs, in order. """
+    ids = []
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i+batch_size]
+        result = db.session.execute(table.insert().values(batch).returning(table.c.id))
+        ids += [row[0] for row in result]
+    return ids
+
+def insert_rows(table, rows, batch_size):
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[i:i+batch_size])
+
+def encoded_images(count, size, seed=0):
+    """ Return a list of JPEG-encoded images of a plate of random colour. """
+    rand = np.random.RandomState(seed)
+    images = []
+    for _ in range(count):
+        pixels = np.empty((size,size,3), dtype=np.uint8)
+        pixels[:] = rand.randint(0, 256, size=3)
+        pixels += rand.randint(0, 16, size=(size,size,3), dtype=np.uint8)
+        buffered = BytesIO()
+        Image.fromarray(pixels).save(buffered, format='jpeg')
+        images.append(buffered.getvalue())
+    return images
+
+def get_exercise_ids():
+    existing = dict(db.session.query(Exercise.name, Exercise.id).all())
+    for name in EXERCISES:
+        if name not in existing:
+            exercise = Exercise(name=name)
+            db.session.add(exercise)
+            db.session.flush()
+            existing[name] = exercise.id
+    return [existing[name] for name in EXERCISES]
+
+def create_user(email, password_hash, display_name):
+    user = User()
+    user.email = email
+    user.password = password_hash
+    db.session.add(user)
+    db.session.flush()
+    profile = UserProfile()
+    profile.id = user.id
+    profile.display_name = display_name
+    profile.prefered_units = WeightUnitsEnum.kgs
+    db.session.add(profile)
+    db.session.flush()
+    return user.id
+
+def generate_foods(user_id, dates, args, rand):
+    """ Insert meals and their items. Returns the IDs of the meals, along with their dates. """
+    meals = []
+    for date in dates:
+        for m in range(args.meals_per_day):
+            meals.append({
+                'user_id': user_id,
+                'date': date,
+                'name': MEALS[m % len(MEALS)],
+                'parent_id': None
+            })
+    meal_ids = insert_returning_ids(Food.__table__, meals, args.batch_size)
+    items = []
+    for meal_id, meal in zip(meal_ids, meals):
+        for _ in range(rand.randint(1, args.items_per_meal)):
+            name, quantity, calories, protein = rand.choice(FOODS)
+            scale = rand.choice([0.5, 1, 1, 1, 1.5, 2])
+            items.append({
+                'user_id': user_id,
+                'date': meal['date'],
+                'name': name,
+                'quantity': quantity,
+                'calories': calories*scale,
+                'protein': protein*scale,
+                'parent_id': meal_id
+            })
+    insert_rows(Food.__table__, items, args.batch_size)
+    return list(zip(meal_ids, [m['date'] for m in meals])), len(meals)+len(items)
+
+def generate_photos(user_id, meals, args, rand, images_32, images_700):
+    rows = []
+    for meal_id, date in meals:
+        if rand.random() >= args.photo_fraction:
+            continue
+        rows.append({
+            'user_id': user_id,
+            'file_name': '',
+            'upload_time': datetime.datetime.combine(date, datetime.time(12)),
+            'date': date,
+            'time': datetime.time(rand.randint(6, 21), rand.randint(0, 59)),
+            'food_id': meal_id
+        })
+    ids = insert_returning_ids(Photo.__table__, rows, args.batch_size)
+    if len(ids) == 0:
+        return 0
+    table = Photo.__table__
+    for i in range(0, len(ids), args.batch_size):
+        db.session.execute(table.update()
+                .where(table.c.id.in_(ids[i:i+args.batch_size]))
+                .values(file_name=table.c.id.cast(String)))
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    for photo_id in ids:
+        for size, images in ((32, images_32), (700, images_700)):
+            with open(os.path.join(folder, '%d-%d' % (photo_id, size)), 'wb') as f:
+                f.write(rand.choice(images))
+    return len(ids)
+
+def generate_bodyweights(user_id, dates, args, rand):
+    rows = []
+    weight = rand.uniform(55, 100)
+    trend = rand.uniform(-0.05, 0.05)
+    for date in dates:
+        weight += trend+rand.gauss(0, 0.1)
+        for _ in range(args.bodyweights_per_day):
+            rows.append({
+                'user_id': user_id,
+                'date': date,
+                'time': datetime.time(rand.randint(6, 22), rand.randint(0, 59)),
+                'bodyweight': weight+rand.gauss(0, 0.4)
+            })
+    insert_rows(Bodyweight.__table__, rows, args.batch_size)
+    return len(rows)
+
+def generate_workouts(user_id, dates, exercise_ids, args, rand):
+    sessions = []
+    for date in dates:
+        if rand.random() < args.workout_fraction:
+            sessions.append({'user_id': user_id, 'date': date, 'order': 0, 'parent_id': None})
+    session_ids = insert_returning_ids(WorkoutSet.__table__, sessions, args.batch_size)
+    rows = []
+    for session_id, session in zip(session_ids, sessions):
+        for order in range(1, args.sets_per_workout+1):
+            exercise_id = exercise_ids[(order-1)//3 % len(exercise_ids)]
+            rows.append({
+                'user_id': user_id,
+                'date': session['date'],
+                'order': order,
+                'parent_id': session_id,
+                'exercise_id': exercise_id,
+                'reps': rand.randint(3, 12),
+                'duration': None
+            })
+    insert_rows(WorkoutSet.__table__, rows, args.batch_size)
+    return len(sessions)+len(rows)
+
+def generate_tags(user_id):
+    count = 0
+    for parent_name, children in TAGS.items():
+        parent = Tag()
+        parent.user_id = user_id
+        parent.tag = parent_name
+        db.session.add(parent)
+        db.session.flush()
+        for name in children:
+            tag = Tag()
+            tag.user_id = user_id
+            tag.tag = name
+            tag.parent_id = parent.id
+            db.session.add(tag)
+        count += 1+len(children)
+    db.session.flush()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a local database with synthetic users for benchmarking.')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--meals-per-day', type=int, default=3)
+    parser.add_argument('--items-per-meal', type=int, default=5, help='Maximum number of items in a meal.')
+    parser.add_argument('--photo-fraction', type=float, default=0.3, help='Fraction of meals with a photo.')
+    parser.add_argument('--bodyweights-per-day', type=int, default=1)
+    parser.add_argument('--workout-fraction', type=float, default=0.4, help='Fraction of days with a workout.')
+    parser.add_argument('--sets-per-workout', type=int, default=12)
+    parser.add_argument('--email-prefix', default='benchmark')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of rows per INSERT statement.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    # A low cost keeps generation fast. bcrypt checks any cost.
+    password_hash = bcrypt.hashpw(args.password.encode('utf-8'), bcrypt.gensalt(4))
+    images_32 = encoded_images(16, 32, args.seed)
+    images_700 = encoded_images(16, 700, args.seed)
+    today = datetime.date.today()
+    dates = [today-datetime.timedelta(days=d) for d in reversed(range(args.days))]
+
+    with app.app_context():
+        check_local_database()
+        db.create_all()
+        exercise_ids = get_exercise_ids()
+        db.session.commit()
+        for n in range(args.users):
+            start = time.perf_counter()
+            email = '%s-%d@example.com' % (args.email_prefix, n)
+            if db.session.query(User).filter_by(email=email).first() is not None:
+                print('%s already exists. Skipping.' % email)
+                continue
+            user_id = create_user(email, password_hash, '%s %d' % (args.email_prefix, n))
+            meals, food_count = generate_foods(user_id, dates, args, rand)
+            counts = {
+                'foods': food_count,
+                'photos': generate_photos(user_id, meals, args, rand, images_32, images_700),
+                'bodyweights': generate_bodyweights(user_id, dates, args, rand),
+                'workout_sets': generate_workouts(user_id, dates, exercise_ids, args, rand),
+                'tags': generate_tags(user_id)
+            }
+            bodyweight_stats.rebuild_bodyweight_stats(user_id)
+            workout_rollups.rebuild_rollups(user_id)
+            tag_tree.rebuild_closure(user_id)
+            db.session.commit()
+            print('Created %s (id %d) in %.1fs: %s' % (email, user_id, time.perf_counter()-start,
+                ', '.join('%d %s' % (v,k) for k,v in counts.items())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+""" Replay mobile client sessions against a running instance of the app.
+
+Each virtual user logs in and repeatedly runs through a session: load
+today's diary, search for a food as it is being typed, upload photos and post
+a meal with them, then view the food and bodyweight summaries. Virtual users
+run in threads and only use the standard library.
+
+The report gives throughput, latency percentiles and the rate of 503s (pool
+timeouts and busy password hashing) per request type, along with connection
+pool usage scraped from `/metrics` on each worker that answered. Run it on
+the same machine as the app, since `/metrics` is local-only.
+
+Photo uploads are sent to the S3 bucket in `LOGS_PHOTO_BUCKET_NAME`. Use
+`--photos-per-meal 0` to leave them out. Logging in many virtual users at
+once needs a higher `PASSWORD_ATTEMPTS_PER_MINUTE` than the default.
+
+Usage:
+    python benchmarks/loadtest.py --url http://localhost:5000 --users 20 --duration 60
+    python benchmarks/loadtest.py --users 50 --ramp-up 10 --output results.jsonl
+"""
+import argparse
+import base64
+import datetime
+import http.cookiejar
+import json
+import platform
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+
+SEARCH_TERMS = ['chicken', 'rice', 'banana', 'coffee', 'salad', 'oatmeal', 'pasta', 'egg']
+MEAL_ITEMS = [
+    {'name': 'Chicken breast', 'quantity': '150 g', 'calories': 248, 'protein': 46},
+    {'name': 'Rice', 'quantity': '1 cup', 'calories': 206, 'protein': 4.3},
+    {'name': 'Broccoli', 'quantity': '1 cup', 'calories': 31, 'protein': 2.5},
+    {'name': 'Coffee', 'quantity': '1 cup', 'calories': 2, 'protein': 0.3},
+]
+
+# An 8x8 JPEG, used when --photo is not given.
+PHOTO = base64.b64decode(
+    '/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAgGBgcGBQgHBwcJCQgKDBQNDAsLDBkSEw8UHRofHh0a'
+    'HBwgJC4nICIsIxwcKDcpLDAxNDQ0Hyc5PTgyPC4zNDL/2wBDAQkJCQwLDBgNDRgyIRwhMjIyMjIy'
+    'MjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjL/wAARCAAIAAgDASIA'
+    'AhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQA'
+    'AAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3'
+    'ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWm'
+    'p6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEA'
+    'AwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSEx'
+    'BhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElK'
+    'U1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3'
+    'uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwCzRRRX'
+    'zJ9Qf//Z')
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, name, status, elapsed):
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            self.statuses[name][status] += 1
+
+class Client(object):
+    """ One virtual user with its own cookie jar. """
+    def __init__(self, base_url, results, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.results = results
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, name, method, path, body=None, headers={}):
+        """ Send a request and record its latency under `name`. Returns the status code and the decoded JSON body, if any. """
+        req = urllib.request.Request(self.base_url+path, data=body, method=method, headers=headers)
+        start = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                status = response.status
+                data = response.read()
+        except urllib.error.HTTPError as e:
+            status = e.code
+            data = e.read()
+        except Exception as e:
+            status = type(e).__name__
+            data = b''
+        self.results.record(name, status, time.perf_counter()-start)
+        try:
+            return status, json.loads(data.decode())
+        except ValueError:
+            return status, None
+
+    def json(self, name, method, path, data):
+        return self.request(name, method, path, json.dumps(data).encode(),
+                {'Content-Type': 'application/json'})
+
+    def upload(self, name, path, fields, file_name, file_data):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for key, value in fields.items():
+            parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, key, value)).encode())
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\nContent-Type: image/jpeg\r\n\r\n' % (boundary, file_name)).encode())
+        parts.append(file_data)
+        parts.append(('\r\n--%s--\r\n' % boundary).encode())
+        return self.request(name, 'POST', path, b''.join(parts),
+                {'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+
+def run_session(client, rand, args):
+    today = str(datetime.date.today())
+    client.request('diary', 'GET', '/api/data/food?date=%s' % today)
+    client.request('photos', 'GET', '/api/data/photos?date=%s' % today)
+    term = rand.choice(SEARCH_TERMS)
+    for i in range(1, min(len(term), args.search_keystrokes)+1):
+        client.request('search', 'GET', '/api/data/food/search?q=%s' % term[:i])
+        time.sleep(args.keystroke_delay)
+    photo_ids = []
+    for _ in range(args.photos_per_meal):
+        status, data = client.upload('photo_upload', '/api/data/photos', {'date': today}, 'meal.jpg', args.photo_data)
+        if status == 200 and data is not None:
+            photo_ids += [int(i) for i in data['entities']['photos'].keys()]
+    meal = {
+        'date': today,
+        'name': 'Lunch',
+        'children': rand.sample(MEAL_ITEMS, 2)
+    }
+    if len(photo_ids) > 0:
+        meal['photo_ids'] = photo_ids
+    client.json('food_post', 'POST', '/api/data/food', meal)
+    client.request('food_summary', 'GET', '/api/data/food/summary')
+    client.request('bodyweight_summary', 'GET', '/api/data/body/weights/summary')
+
+def virtual_user(n, args, results, deadline):
+    rand = random.Random(args.seed+n)
+    client = Client(args.url, results, args.timeout)
+    status, _ = client.json('login', 'POST', '/api/auth/login', {
+        'email': args.email_pattern % (n % args.accounts),
+        'password': args.password
+    })
+    if status != 200:
+        print('Virtual user %d could not log in (%s).' % (n, status))
+        return
+    while time.monotonic() < deadline:
+        run_session(client, rand, args)
+        time.sleep(rand.expovariate(1/args.think_time) if args.think_time > 0 else 0)
+
+def scrape_metrics(url, pool_stats, stop, interval):
+    """ Poll `/metrics` and keep the latest connection pool numbers reported by each worker process. """
+    while not stop.wait(interval):
+        try:
+            with urllib.request.urlopen(url.rstrip('/')+'/metrics?format=json', timeout=5) as response:
+                data = json.loads(response.read().decode())
+        except Exception:
+            continue
+        stats = {}
+        for name, metric in data['metrics'].items():
+            if name.startswith('db_pool_') and len(metric['samples']) > 0:
+                stats[name] = metric['samples'][0]['value']
+        pool_stats[data['pid']] = stats
+
+def percentiles(values):
+    values = sorted(values)
+    def p(q):
+        return values[min(int(q*len(values)), len(values)-1)]*1000
+    return {
+        'p50_ms': p(0.5),
+        'p90_ms': p(0.9),
+        'p99_ms': p(0.99),
+        'max_ms': values[-1]*1000,
+        'mean_ms': sum(values)/len(values)*1000
+    }
+
+def summarize(results, elapsed):
+    requests = {}
+    total = 0
+    total_503 = 0
+    for name in sorted(results.latencies.keys()):
+        statuses = results.statuses[name]
+        count = sum(statuses.values())
+        total += count
+        total_503 += statuses.get(503, 0)
+        requests[name] = dict(percentiles(results.latencies[name]),
+                count=count,
+                throughput=count/elapsed,
+                rate_503=statuses.get(503, 0)/count,
+                statuses=dict((str(k),v) for k,v in statuses.items()))
+    return {
+        'requests': requests,
+        'total_requests': total,
+        'throughput': total/elapsed,
+        'rate_503': total_503/total if total > 0 else 0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the API with simulated client sessions.')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=10, help='Number of concurrent virtual users.')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to run for.')
+    parser.add_argument('--ramp-up', type=float, default=0, help='Seconds over which virtual users are started.')
+    parser.add_argument('--accounts', type=int, default=10, help='Number of generated accounts to spread the virtual users over.')
+    parser.add_argument('--email-pattern', default='benchmark-%d@example.com')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--photos-per-meal', type=int, default=1)
+    parser.add_argument('--photo', default=None, help='JPEG file to upload as meal photos. A tiny generated image is used if not provided.')
+    parser.add_argument('--search-keystrokes', type=int, default=4)
+    parser.add_argument('--keystroke-delay', type=float, default=0.15)
+    parser.add_argument('--think-time', type=float, default=2, help='Mean seconds between sessions.')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--metrics-interval', type=float, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='File to append the JSON report to. Defaults to stdout.')
+    args = parser.parse_args()
+    if args.photo is not None:
+        with open(args.photo, 'rb') as f:
+            args.photo_data = f.read()
+    else:
+        args.photo_data = PHOTO
+
+    results = Results()
+    pool_stats = {}
+    stop = threading.Event()
+    scraper = threading.Thread(target=scrape_metrics, args=(args.url, pool_stats, stop, args.metrics_interval), daemon=True)
+    scraper.start()
+
+    start = time.monotonic()
+    deadline = start+args.duration
+    threads = []
+    for n in range(args.users):
+        thread = threading.Thread(target=virtual_user, args=(n, args, results, deadline), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if args.ramp_up > 0:
+            time.sleep(args.ramp_up/args.users)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic()-start
+    stop.set()
+    scraper.join()
+
+    report = dict(summarize(results, elapsed),
+            benchmark='loadtest',
+            timestamp=datetime.datetime.utcnow().isoformat(),
+            python=platform.python_version(),
+            config=dict((k,v) for k,v in vars(args).items() if k != 'photo_data'),
+            elapsed=elapsed,
+            pool=dict((str(k),v) for k,v in pool_stats.items()))
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report)+'\n')
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+""" Time the hot `dbutils` functions and resource handlers against generated data.
+
+Run `benchmarks/generate_data.py` first. Each case is run `--iterations`
+times for one benchmark user and reported as one JSON object with latency
+percentiles and the number of SQL statements per call, so results can be
+compared across commits.
+
+Cases are run warm (after warmup, so the in-process caches are filled) and
+cold (with the caches emptied before every call). Warm numbers mostly measure
+cache hits; cold numbers measure the handlers and their queries.
+
+Usage:
+    python benchmarks/microbench.py --output results.jsonl
+    python benchmarks/microbench.py --email benchmark-3@example.com --filter food
+    python benchmarks/microbench.py --mode cold
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fitnessapp import app
+from fitnessapp.extensions import db
+from fitnessapp import dbutils, food_context, tag_tree, user_cache
+from fitnessapp.resources import body
+from tracker_database import User, Food, Photo
+
+_query_count = [0]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    _query_count[0] += 1
+
+def clear_caches():
+    """ Empty the in-process caches that sit in front of the timed functions. """
+    user_cache._users.clear()
+    user_cache._profiles.clear()
+    tag_tree._tags.clear()
+    food_context._models.clear()
+    body.series_cache.clear()
+
+def time_case(fn, iterations, warmup, cold=False):
+    """ Call `fn` repeatedly and return its latency percentiles and the number of SQL statements per call.
+    If `cold` is true, the caches are emptied before every call, outside of the timed section.
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    queries = _query_count[0]
+    for _ in range(iterations):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter()-start)
+    queries = _query_count[0]-queries
+    timings = np.array(timings)*1000
+    return {
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'mean_ms': float(timings.mean()),
+        'queries_per_call': queries/iterations
+    }
+
+def dbutils_cases(user_id):
+    """ Return a list of (name, function) pairs calling `dbutils` directly. """
+    latest = db.session.query(Food.date) \
+            .filter_by(user_id=user_id) \
+            .order_by(Food.date.desc()) \
+            .first()[0]
+    meals = db.session.query(Food) \
+            .filter_by(user_id=user_id) \
+            .filter_by(date=latest) \
+            .filter(Food.parent_id.is_(None)) \
+            .all()
+    photo = db.session.query(Photo) \
+            .filter_by(user_id=user_id) \
+            .order_by(Photo.id.desc()) \
+            .first()
+    photos = db.session.query(Photo) \
+            .filter_by(user_id=user_id) \
+            .order_by(Photo.id.desc()) \
+            .limit(100) \
+            .all()
+    cases = [
+        ('dbutils.food_to_dict', lambda: [dbutils.food_to_dict(f, with_children_data=True) for f in meals]),
+        ('dbutils.search_food_frequent', lambda: dbutils.search_food_frequent('chi', user_id)),
+        ('dbutils.search_food_recent', lambda: dbutils.search_food_recent('chi', user_id)),
+        ('dbutils.search_food_premade', lambda: dbutils.search_food_premade('chi', user_id)),
+        ('dbutils.search_food_nutrition', lambda: dbutils.search_food_nutrition('Rice', 'cup', user_id)),
+        ('dbutils.autogroup_photos', lambda: dbutils.autogroup_photos(photos)),
+        ('food_context.predict', lambda: food_context.predict(user_id, 'Breakfast', ['Coffee'])),
+    ]
+    if photo is not None:
+        cases.append(('dbutils.get_photo_data_base64', lambda: dbutils.get_photo_data_base64(photo.id)))
+    return cases
+
+def resource_cases(today):
+    """ Return a list of (name, method, url) requests to time through the test client. """
+    start = today-datetime.timedelta(days=365)
+    return [
+        ('GET /food?date', 'get', '/api/data/food?date=%s' % today),
+        ('GET /food/search', 'get', '/api/data/food/search?q=chi'),
+        ('GET /food/summary', 'get', '/api/data/food/summary'),
+        ('GET /food/predict', 'get', '/api/data/food/predict?parent=Breakfast&siblings=Coffee'),
+        ('GET /photos?date', 'get', '/api/data/photos?date=%s' % today),
+        ('GET /body/weights/summary', 'get', '/api/data/body/weights/summary'),
+        ('GET /body/weights/series', 'get', '/api/data/body/weights/series?start_date=%s&end_date=%s&points=200' % (start, today)),
+        ('GET /workout/sessions', 'get', '/api/data/workout/sessions?start_date=%s&end_date=%s' % (start, today)),
+        ('GET /exercises', 'get', '/api/data/exercises'),
+        ('GET /tags', 'get', '/api/data/tags'),
+        ('GET /tags/search', 'get', '/api/data/tags/search?q=fr'),
+    ]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Time dbutils functions and resource handlers.')
+    parser.add_argument('--email', default='benchmark-0@example.com')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--filter', default=None, help='Only run cases whose name contains this string.')
+    parser.add_argument('--mode', default='both', choices=['warm', 'cold', 'both'], help='Whether to run with the caches filled, emptied before every call, or both.')
+    parser.add_argument('--output', default=None, help='File to append JSON lines to. Defaults to stdout.')
+    args = parser.parse_args()
+
+    metadata = {
+        'benchmark': 'microbench',
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine()
+    }
+    output = open(args.output, 'a') if args.output is not None else sys.stdout
+    modes = ['warm', 'cold'] if args.mode == 'both' else [args.mode]
+    def report(kind, name, mode, result):
+        result = dict(metadata, kind=kind, case=name, mode=mode, iterations=args.iterations, **result)
+        output.write(json.dumps(result)+'\n')
+        output.flush()
+
+    with app.app_context():
+        user = db.session.query(User).filter_by(email=args.email).first()
+        if user is None:
+            raise SystemExit('No user %s. Run benchmarks/generate_data.py first.' % args.email)
+        for name, fn in dbutils_cases(user.id):
+            if args.filter is not None and args.filter not in name:
+                continue
+            for mode in modes:
+                report('dbutils', name, mode, time_case(fn, args.iterations, args.warmup, cold=(mode == 'cold')))
+                db.session.rollback()
+
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': args.email, 'password': args.password})
+    if response.status_code != 200:
+        raise SystemExit('Unable to log in as %s: %s' % (args.email, response.data))
+    for name, method, url in resource_cases(datetime.date.today()):
+        if args.filter is not None and args.filter not in name:
+            continue
+        for mode in modes:
+            statuses = set()
+            def request():
+                statuses.add(getattr(client, method)(url).status_code)
+            result = time_case(request, args.iterations, args.warmup, cold=(mode == 'cold'))
+            result['status'] = sorted(statuses)
+            report('resource', name, mode, result)
+
+    if output is not sys.stdout:
+        output.close()
+
+if __name__ == '__main__':
+    main()
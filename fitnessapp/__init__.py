@@ -3,8 +3,11 @@ from flask import Flask, jsonify
 import sqlalchemy
 import json
 import traceback
+import datetime
+import click
 
 from fitnessapp.extensions import login_manager, db, swagger, cors
+from fitnessapp import metrics, dbpool, request_metrics, tracing, compression
 
 from tracker_database import User
 
@@ -21,24 +24,30 @@ cors.init_app(app, supports_credentials=True)
 swagger.init_app(app)
 db.init_app(app)
 login_manager.init_app(app)
+metrics.init_app(app)
+dbpool.init_app(app)
+request_metrics.init_app(app)
+tracing.init_app(app)
+compression.init_app(app)
 
 @app.route('/favicon.ico')
 def favicon_paths():
-    return app.send_static_file("favicon.ico")
+    return compression.send_static("favicon.ico")
 
 @app.route('/static', defaults={'path': ''})
 @app.route('/static/<path:path>')
 def static_paths(path):
-    return app.send_static_file('static/'+path)
+    return compression.send_static('static/'+path)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def react_paths(path):
-    return app.send_static_file("index.html")
+    return compression.send_index()
 
 @app.errorhandler(sqlalchemy.exc.TimeoutError)
 def timeouterror_handler(error):
     print(traceback.format_exc())
+    dbpool.timeouts.inc()
     db.session.rollback()
     return json.dumps({
         'error': 'Server too busy. Try again later.'
@@ -71,3 +80,55 @@ app.register_blueprint(labels_bp, url_prefix='/api/data')
 app.register_blueprint(body_bp, url_prefix='/api/data')
 app.register_blueprint(workout_bp, url_prefix='/api/data')
 app.register_blueprint(exercise_bp, url_prefix='/api/data')
+
+@app.cli.command('autogenerate-food')
+@click.option('--user-id', type=int, required=True)
+@click.option('--start-date', default=None, help='First date of a range to process (YYYY-MM-DD).')
+@click.option('--end-date', default=None, help='Last date of a range to process (YYYY-MM-DD).')
+@click.argument('dates', nargs=-1)
+def autogenerate_food_command(user_id, start_date, end_date, dates):
+    """ Create food entries from a user's unassigned photos. """
+    from fitnessapp import dbutils
+    dates = list(dates)
+    if start_date is not None and end_date is not None:
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+        while start_date <= end_date:
+            dates.append(str(start_date))
+            start_date += datetime.timedelta(days=1)
+    created = dbutils.autogenerate_food_entries(user_id, dates)
+    for date,count in created.items():
+        print(date, count)
+
+@app.cli.command('rebuild-workout-rollups')
+@click.option('--user-id', type=int, default=None, help='Only rebuild the rollups of this user.')
+def rebuild_workout_rollups_command(user_id):
+    """ Recompute the per-exercise daily workout rollups from the raw sets. """
+    from fitnessapp import workout_rollups
+    workout_rollups.rebuild_rollups(user_id)
+    db.session.commit()
+
+@app.cli.command('rebuild-tag-closure')
+@click.option('--user-id', type=int, default=None, help='Only rebuild the tags of this user.')
+def rebuild_tag_closure_command(user_id):
+    """ Recompute the tag closure table from the tags' parent IDs. """
+    from fitnessapp import tag_tree
+    tag_tree.rebuild_closure(user_id)
+    db.session.commit()
+
+@app.cli.command('rebuild-bodyweight-stats')
+@click.option('--user-id', type=int, default=None, help='Only rebuild the statistics of this user.')
+def rebuild_bodyweight_stats_command(user_id):
+    """ Recompute the hourly and daily bodyweight statistics from the raw entries. """
+    from fitnessapp import bodyweight_stats
+    if user_id is None:
+        bodyweight_stats.rebuild_all_bodyweight_stats()
+    else:
+        bodyweight_stats.rebuild_bodyweight_stats(user_id)
+    db.session.commit()
+
+@app.cli.command('precompress-static')
+def precompress_static_command():
+    """ Write gzip and brotli copies of the static files, to be run after building the frontend. """
+    count = compression.precompress_static(app.static_folder)
+    print('Precompressed %d static files.' % count)
@@ -0,0 +1,267 @@
+""" Per-user bodyweight statistics maintained incrementally on write.
+
+Bodyweight write paths call `add_bodyweights` after flushing new entries and
+`remove_bodyweights` before deleting entries, in the same transaction. The
+summary endpoint then reads 24 hourly rows and at most a week of daily rows
+instead of scanning the user's full history.
+
+Users whose statistics have never been computed get them built on their
+next write. Entries that predate the statistics tables are backfilled with
+`flask rebuild-bodyweight-stats`.
+"""
+from collections import defaultdict
+import datetime
+import numpy as np
+
+from sqlalchemy import func, select
+
+from tracker_database import Bodyweight
+from fitnessapp.extensions import db
+from fitnessapp.models import BodyweightHourlyStats, BodyweightDailyStats
+
+def parse_date(value):
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+def parse_time(value):
+    if isinstance(value, str):
+        if value == '':
+            return None
+        for fmt in ['%H:%M:%S', '%H:%M']:
+            try:
+                return datetime.datetime.strptime(value, fmt).time()
+            except ValueError:
+                pass
+        raise ValueError('Invalid time: %s' % value)
+    return value
+
+def _entries_to_arrays(entries):
+    """ Convert bodyweight entries (objects or (date, time, bodyweight) tuples) to parallel lists. Entries without a bodyweight are skipped. """
+    dates = []
+    hours = []
+    weights = []
+    for e in entries:
+        if isinstance(e, tuple):
+            date, time, weight = e
+        else:
+            date, time, weight = e.date, e.time, e.bodyweight
+        if weight is None:
+            continue
+        time = parse_time(time)
+        dates.append(parse_date(date))
+        hours.append(time.hour if time is not None else None)
+        weights.append(float(weight))
+    return dates, hours, weights
+
+def _hourly_moments(hours, weights):
+    """ Return a dictionary mapping each hour to the (count, mean, M2) of the given weights. """
+    by_hour = defaultdict(list)
+    for h,w in zip(hours, weights):
+        if h is not None:
+            by_hour[h].append(w)
+    moments = {}
+    for h,ws in by_hour.items():
+        ws = np.array(ws)
+        mean = ws.mean()
+        moments[h] = (len(ws), float(mean), float(((ws-mean)**2).sum()))
+    return moments
+
+# First key of the advisory locks serializing statistics updates. The second key is the user ID.
+LOCK_CLASS = 0x62777374
+
+def _daily_sums(dates, hours, weights):
+    """ Return a dictionary mapping each date to the [count, total, timed_count, timed_total] of the given weights. """
+    sums = defaultdict(lambda: [0, 0., 0, 0.])
+    for d,h,w in zip(dates, hours, weights):
+        sums[d][0] += 1
+        sums[d][1] += w
+        if h is not None:
+            sums[d][2] += 1
+            sums[d][3] += w
+    return sums
+
+def merge_moments(a, b):
+    """ Combine the (count, mean, M2) of two disjoint sets of values. """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a+n_b
+    if n == 0:
+        return 0, 0., 0.
+    delta = mean_b-mean_a
+    mean = mean_a+delta*n_b/n
+    m2 = m2_a+m2_b+delta**2*n_a*n_b/n
+    return n, mean, m2
+
+def subtract_moments(total, b):
+    """ Inverse of `merge_moments`. Given the moments of a set of values and of a subset `b`, return the moments of the remaining values. """
+    n, mean, m2 = total
+    n_b, mean_b, m2_b = b
+    n_a = n-n_b
+    if n_a <= 0:
+        return 0, 0., 0.
+    mean_a = (n*mean-n_b*mean_b)/n_a
+    delta = mean_b-mean_a
+    m2_a = m2-m2_b-delta**2*n_a*n_b/n
+    return n_a, mean_a, max(m2_a, 0.)
+
+def _lock_stats(user_id):
+    """ Serialize updates to a user's statistics until the end of the transaction, so two first writes do not both rebuild them. """
+    db.session.execute(select([func.pg_advisory_xact_lock(LOCK_CLASS, user_id)]))
+
+def _has_stats(user_id):
+    return db.session.query(BodyweightDailyStats.user_id) \
+            .filter_by(user_id=user_id) \
+            .first() is not None
+
+def rebuild_bodyweight_stats(user_id):
+    """ Recompute all of a user's statistics from their full history. Does not commit. """
+    _lock_stats(user_id)
+    db.session.query(BodyweightHourlyStats) \
+            .filter_by(user_id=user_id) \
+            .delete(synchronize_session=False)
+    db.session.query(BodyweightDailyStats) \
+            .filter_by(user_id=user_id) \
+            .delete(synchronize_session=False)
+    entries = db.session.query(Bodyweight) \
+            .with_entities(
+                    Bodyweight.date,
+                    Bodyweight.time,
+                    Bodyweight.bodyweight
+            ) \
+            .filter_by(user_id=user_id) \
+            .filter(Bodyweight.bodyweight.isnot(None)) \
+            .all()
+    dates, hours, weights = _entries_to_arrays([tuple(e) for e in entries])
+    for h,(n,mean,m2) in _hourly_moments(hours, weights).items():
+        db.session.add(BodyweightHourlyStats(user_id=user_id, hour=h, count=n, mean=mean, m2=m2))
+    for d,(n,total,timed_n,timed_total) in _daily_sums(dates, hours, weights).items():
+        db.session.add(BodyweightDailyStats(user_id=user_id, date=d, count=n, total=total,
+                timed_count=timed_n, timed_total=timed_total))
+    db.session.flush()
+
+def rebuild_all_bodyweight_stats():
+    """ Recompute the statistics of every user with bodyweight entries. Does not commit. """
+    user_ids = db.session.query(Bodyweight) \
+            .with_entities(Bodyweight.user_id) \
+            .distinct() \
+            .all()
+    for (user_id,) in user_ids:
+        rebuild_bodyweight_stats(user_id)
+
+def _update_stats(user_id, entries, sign):
+    dates, hours, weights = _entries_to_arrays(entries)
+    if len(weights) == 0:
+        return
+
+    moments = _hourly_moments(hours, weights)
+    if len(moments) > 0:
+        rows = db.session.query(BodyweightHourlyStats) \
+                .filter_by(user_id=user_id) \
+                .filter(BodyweightHourlyStats.hour.in_(list(moments.keys()))) \
+                .with_for_update() \
+                .all()
+        rows = dict([(r.hour, r) for r in rows])
+        for h,m in moments.items():
+            row = rows.get(h)
+            if row is None:
+                if sign < 0:
+                    continue
+                row = BodyweightHourlyStats(user_id=user_id, hour=h, count=0, mean=0., m2=0.)
+                db.session.add(row)
+            if sign > 0:
+                n, mean, m2 = merge_moments((row.count, row.mean, row.m2), m)
+            else:
+                n, mean, m2 = subtract_moments((row.count, row.mean, row.m2), m)
+            row.count, row.mean, row.m2 = n, mean, m2
+
+    sums = _daily_sums(dates, hours, weights)
+    rows = db.session.query(BodyweightDailyStats) \
+            .filter_by(user_id=user_id) \
+            .filter(BodyweightDailyStats.date.in_(list(sums.keys()))) \
+            .with_for_update() \
+            .all()
+    rows = dict([(r.date, r) for r in rows])
+    for d,(n,total,timed_n,timed_total) in sums.items():
+        row = rows.get(d)
+        if row is None:
+            if sign < 0:
+                continue
+            row = BodyweightDailyStats(user_id=user_id, date=d, count=0, total=0.,
+                    timed_count=0, timed_total=0.)
+            db.session.add(row)
+        row.count += sign*n
+        row.total += sign*total
+        row.timed_count += sign*timed_n
+        row.timed_total += sign*timed_total
+        if row.count <= 0:
+            db.session.delete(row)
+    db.session.flush()
+
+def add_bodyweights(user_id, entries):
+    """ Add new bodyweight entries to the user's statistics.
+    Must be called after the entries are flushed, in the same transaction. Does not commit.
+    """
+    _lock_stats(user_id)
+    if not _has_stats(user_id):
+        # The rebuild already includes the new entries.
+        rebuild_bodyweight_stats(user_id)
+        return
+    _update_stats(user_id, entries, 1)
+
+def remove_bodyweights(user_id, entries):
+    """ Remove bodyweight entries from the user's statistics.
+    Must be called before the entries are deleted, in the same transaction. Does not commit.
+    """
+    _lock_stats(user_id)
+    if not _has_stats(user_id):
+        rebuild_bodyweight_stats(user_id)
+    _update_stats(user_id, entries, -1)
+
+def get_hourly_stats(user_id):
+    """ Return two lists of length 24 containing the mean and standard deviation of the user's bodyweight at each hour of the day.
+    Hours with no entries are `None`.
+    """
+    rows = db.session.query(BodyweightHourlyStats) \
+            .filter_by(user_id=user_id) \
+            .all()
+    mean = [None]*24
+    std = [None]*24
+    for r in rows:
+        if r.count <= 0:
+            continue
+        mean[r.hour] = r.mean
+        std[r.hour] = float(np.sqrt(r.m2/r.count))
+    return mean, std
+
+def get_weight_change_per_day(user_id, days=7):
+    """ Return the slope of the least-squares line through the entries logged in the `days` days up to the user's most recent entry.
+    Only entries with a time are used.
+    """
+    end_date = db.session.query(BodyweightDailyStats) \
+            .with_entities(db.func.max(BodyweightDailyStats.date)) \
+            .filter_by(user_id=user_id) \
+            .filter(BodyweightDailyStats.timed_count > 0) \
+            .scalar()
+    if end_date is None:
+        return None
+    start_date = end_date-datetime.timedelta(days=days)
+    rows = db.session.query(BodyweightDailyStats) \
+            .filter_by(user_id=user_id) \
+            .filter(BodyweightDailyStats.date >= start_date) \
+            .filter(BodyweightDailyStats.timed_count > 0) \
+            .all()
+    n = np.array([r.timed_count for r in rows], dtype=float)
+    x = np.array([(r.date-start_date).days for r in rows], dtype=float)
+    y = np.array([r.timed_total for r in rows], dtype=float)
+    count = n.sum()
+    if count <= 2:
+        return None
+    sx = (n*x).sum()
+    sxx = (n*x*x).sum()
+    sy = y.sum()
+    sxy = (x*y).sum()
+    denominator = count*sxx-sx*sx
+    if denominator == 0:
+        return None
+    return float((count*sxy-sx*sy)/denominator)
@@ -0,0 +1,216 @@
+""" Response compression.
+
+API responses larger than `COMPRESS_MIN_SIZE` bytes are compressed with
+brotli (if the brotli package is installed) or gzip, depending on the
+request's Accept-Encoding. Streamed responses (e.g. a user's full history,
+see `fitnessapp.encoding.stream_entities`) are compressed chunk by chunk as
+they are generated, whatever their size.
+
+Static files are compressed ahead of time: `.gz` and `.br` copies are written
+next to them when the app starts (or with `flask precompress-static` at build
+time), and `send_static` serves the best copy the client accepts, so serving
+them costs no CPU. Files with a content hash in their name are cached by
+clients indefinitely. `index.html` is kept in memory.
+"""
+import gzip
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import zlib
+from io import BytesIO
+
+from flask import Response, request, send_file, safe_join, abort
+from flask import current_app as app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ['application/json', 'application/javascript', 'image/svg+xml']
+STATIC_EXTENSIONS = ['.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.ico']
+# e.g. main.3f2a9c1b.chunk.js, as produced by the React build
+HASHED_FILE_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+IMMUTABLE_MAX_AGE = 60*60*24*365
+
+_index = None
+_index_lock = threading.Lock()
+
+def _encodings():
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+def accepted_encoding():
+    """ Return the best content encoding the client accepts, or `None`. """
+    return request.accept_encodings.best_match(_encodings())
+
+def compress(data, encoding, level=6, quality=4):
+    if encoding == 'br':
+        return brotli.compress(data, quality=quality)
+    buffered = BytesIO()
+    with gzip.GzipFile(fileobj=buffered, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buffered.getvalue()
+
+def _compressible(response):
+    mimetype = response.mimetype or ''
+    return mimetype in COMPRESSIBLE_MIMETYPES or mimetype.startswith('text/')
+
+def compress_stream(chunks, encoding, level=6, quality=4):
+    """ Compress an iterable of byte strings, yielding compressed data as each chunk is read so the client can start decoding before the stream ends. """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=quality)
+        flush = compressor.flush
+        finish = compressor.finish
+        process = compressor.process
+    else:
+        # wbits of 16+MAX_WBITS writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+        process = compressor.compress
+    try:
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            yield process(chunk) + flush()
+        yield finish()
+    finally:
+        # Lets `stream_with_context` generators clean up if the client disconnects
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def compress_response(response):
+    if (response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or not _compressible(response)):
+        return response
+    response.vary.add('Accept-Encoding')
+    level = app.config.get('COMPRESS_LEVEL', 6)
+    quality = app.config.get('COMPRESS_BROTLI_QUALITY', 4)
+    if response.is_streamed:
+        # The size is unknown until the stream ends, so it is always compressed
+        encoding = accepted_encoding()
+        if encoding is None:
+            return response
+        response.response = compress_stream(response.response, encoding, level, quality)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config.get('COMPRESS_MIN_SIZE', 1024):
+            return response
+        encoding = accepted_encoding()
+        if encoding is None:
+            return response
+        response.set_data(compress(data, encoding, level, quality))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body is not byte-for-byte the same, so strong ETags become weak
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def _write_atomic(file_name, data):
+    """ Write a file through a temporary file, so processes starting at the same time never see it half-written. """
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(file_name))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_name, file_name)
+
+def precompress_static(folder, min_size=1024):
+    """ Write compressed copies of the static files in `folder` that are missing or out of date. Returns the number of files written. """
+    count = 0
+    for directory, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            if os.path.splitext(file_name)[1] not in STATIC_EXTENSIONS:
+                continue
+            path = os.path.join(directory, file_name)
+            mtime = os.path.getmtime(path)
+            if os.path.getsize(path) < min_size:
+                continue
+            data = None
+            for encoding, suffix in (('gzip', '.gz'), ('br', '.br')):
+                if encoding == 'br' and brotli is None:
+                    continue
+                if os.path.exists(path+suffix) and os.path.getmtime(path+suffix) >= mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                # Maximum compression, since this only happens once per file
+                _write_atomic(path+suffix, compress(data, encoding, level=9, quality=11))
+                count += 1
+    return count
+
+def _cache_headers(path):
+    if HASHED_FILE_NAME.search(os.path.basename(path)):
+        return {'Cache-Control': 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE}
+    return {}
+
+def send_static(path):
+    """ Serve a file from the static folder, using a precompressed copy if there is one the client accepts. """
+    file_name = safe_join(app.static_folder, path)
+    if file_name is None or not os.path.isfile(file_name):
+        abort(404)
+    mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    headers = _cache_headers(file_name)
+    cache_timeout = IMMUTABLE_MAX_AGE if len(headers) > 0 else None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding not in _encodings() or not os.path.isfile(file_name+suffix):
+            continue
+        if request.accept_encodings[encoding] == 0:
+            continue
+        response = send_file(file_name+suffix, mimetype=mimetype,
+                conditional=True, cache_timeout=cache_timeout)
+        response.headers['Content-Encoding'] = encoding
+        break
+    else:
+        response = send_file(file_name, mimetype=mimetype,
+                conditional=True, cache_timeout=cache_timeout)
+    response.vary.add('Accept-Encoding')
+    for key, value in headers.items():
+        response.headers[key] = value
+    return response
+
+def _load_index(file_name):
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    variants = {None: data}
+    for encoding in _encodings():
+        variants[encoding] = compress(data, encoding, level=9, quality=11)
+    return os.path.getmtime(file_name), variants
+
+def send_index():
+    """ Serve `index.html` from memory. It is reloaded when the file changes. """
+    global _index
+    file_name = os.path.join(app.static_folder, 'index.html')
+    try:
+        mtime = os.path.getmtime(file_name)
+    except OSError:
+        abort(404)
+    with _index_lock:
+        if _index is None or _index[0] != mtime:
+            _index = _load_index(file_name)
+        variants = _index[1]
+    encoding = accepted_encoding()
+    response = Response(variants[encoding], mimetype='text/html')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Always revalidate, so clients pick up new builds
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def init_app(app):
+    app.after_request(compress_response)
+    if app.config.get('COMPRESS_STATIC_ON_START', True) and os.path.isdir(app.static_folder):
+        try:
+            count = precompress_static(app.static_folder)
+            if count > 0:
+                print('Precompressed %d static files.' % count)
+        except OSError as e:
+            print('Unable to precompress static files: %s' % e)
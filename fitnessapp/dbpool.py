@@ -0,0 +1,44 @@
+""" Connection pool metrics.
+
+All resources share the Flask-SQLAlchemy engine, so these numbers are the
+actual per-worker connection usage to compare against
+`SQLALCHEMY_POOL_SIZE` and `SQLALCHEMY_MAX_OVERFLOW`.
+"""
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from fitnessapp import metrics
+from fitnessapp.extensions import db
+
+connections_opened = metrics.counter('db_pool_connections_opened_total', 'Number of new database connections opened.')
+checkouts = metrics.counter('db_pool_checkouts_total', 'Number of connections checked out of the pool.')
+checked_out = metrics.gauge('db_pool_checked_out', 'Number of connections currently checked out.')
+checked_out_max = metrics.gauge('db_pool_checked_out_max', 'Largest number of connections checked out at once since the worker started.')
+timeouts = metrics.counter('db_pool_timeouts_total', 'Number of requests that gave up waiting for a connection.')
+
+@event.listens_for(Pool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    connections_opened.inc()
+
+@event.listens_for(Pool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    checkouts.inc()
+    checked_out_max.set_max(checked_out.inc())
+
+@event.listens_for(Pool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    checked_out.dec()
+
+def _pool_status():
+    pool = db.engine.pool
+    status = []
+    for name, description, attr in [
+            ('db_pool_size', 'Configured number of connections kept in the pool.', 'size'),
+            ('db_pool_checked_in', 'Number of idle connections in the pool.', 'checkedin'),
+            ('db_pool_overflow', 'Number of connections opened beyond the pool size.', 'overflow')]:
+        if hasattr(pool, attr):
+            status.append((name, description, {}, getattr(pool, attr)()))
+    return status
+
+def init_app(app):
+    metrics.register_collector(_pool_status)
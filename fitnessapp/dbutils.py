@@ -7,6 +7,7 @@ from io import BytesIO
 import base64
 import boto3
 import re
+import numpy as np
 
 from flask import current_app as app
 
@@ -14,6 +15,7 @@ from tracker_database import Food, Photo
 import tracker_data
 import tracker_data.food101.train
 from fitnessapp.extensions import db
+from fitnessapp import food_context, tracing, versions
 
 s3 = boto3.resource('s3')
 
@@ -96,6 +98,7 @@ def update_food_from_dict(data, user_id, parent=None):
             if p.food_id is not None and p.food_id != f.id:
                 raise Exception('Photo %d is already assigned to diet entry %d. Cannot reassign.' % (p.id, p.food_id))
             p.food_id = f.id
+        versions.bump_version('photos', user_id)
 
     db.session.flush()
 
@@ -108,7 +111,9 @@ def update_food_from_dict(data, user_id, parent=None):
 
     # Commit once when everything is done.
     if parent is None:
+        versions.bump_version('food', user_id)
         db.session.commit()
+        food_context.update_entries(user_id, changed_entities)
 
     return changed_entities
 
@@ -116,6 +121,7 @@ def delete_food(food, depth=0):
     """ Delete a food entry along with all children recursively.
     """
     deleted_ids = [food.id]
+    user_id = food.user_id
     children = db.session.query(Food) \
                 .filter_by(parent_id=food.id) \
                 .all()
@@ -126,7 +132,9 @@ def delete_food(food, depth=0):
     db.session.flush()
 
     if depth == 0:
+        versions.bump_version('food', user_id)
         db.session.commit()
+        food_context.remove_entries(user_id, deleted_ids)
 
     return deleted_ids
 
@@ -250,13 +258,20 @@ def search_food_nutrition(name, units, user_id):
             'mean': mean_entry
     }
 
+@tracing.traced
 def get_photo_file_name(photo_id, format='png', size=32):
-    filename = str(photo_id)
     fp = db.session.query(Photo) \
             .filter_by(id=photo_id) \
             .one()
     if fp is None:
         raise Exception("File ID not found.")
+    return get_local_photo_file_name(fp, size)
+
+@tracing.traced
+def get_local_photo_file_name(fp, size=32):
+    """ Return the name of a local copy of the given photo at the requested size, downloading it if necessary. """
+    photo_id = fp.id
+    filename = str(photo_id)
     if not os.path.isdir(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
 
@@ -274,15 +289,16 @@ def get_photo_file_name(photo_id, format='png', size=32):
                 '%s-700'%(fp.file_name))
         filename_resized = local_file_name
         try:
-            with open(filename, "wb") as f:
+            with open(filename, "wb") as f, tracing.span('s3.download', key=str(photo_id)):
                 s3.Bucket(app.config['LOGS_PHOTO_BUCKET_NAME']) \
                   .Object(str(photo_id)) \
                   .download_fileobj(f)
             img = Image.open(filename)
             if size == 700:
                 return img
-            img.thumbnail((size,size))
-            img.save(filename_resized,'PNG')
+            with tracing.span('pillow.thumbnail', size=size):
+                img.thumbnail((size,size))
+                img.save(filename_resized,'PNG')
             return img
         except Exception as e:
             print("Unable to retrieve file %s from AWS servers." % filename)
@@ -297,6 +313,7 @@ def get_photo_file_name(photo_id, format='png', size=32):
 
     return local_file_name
 
+@tracing.traced
 def get_photo_data_base64(photo_id, format='png', size=32):
     file_name = get_photo_file_name(photo_id, format, size)
     with open(file_name, 'rb') as f:
@@ -306,15 +323,19 @@ def get_photo_data_base64(photo_id, format='png', size=32):
     img_str = base64.b64encode(buffered.getvalue())
     return img_str.decode()
 
+@tracing.traced
 def save_photo_data(file, file_name, delete_local=True):
     print('saving file ', file_name)
     # Save file
     file_name_original = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
     file_name_700 = os.path.join(app.config['UPLOAD_FOLDER'],'%s-700' % file_name)
     file_name_32 = os.path.join(app.config['UPLOAD_FOLDER'],'%s-32' % file_name)
-    file.save(file_name_original)
+    with tracing.span('file.save'):
+        file.save(file_name_original)
     # Resize photo
-    img = Image.open(file_name_original)
+    with tracing.span('pillow.decode'):
+        img = Image.open(file_name_original)
+        img.load()
     # Remove transparency if there's an alpha channel
     if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
         print('Found transparency. Processing alpha channels.')
@@ -323,19 +344,22 @@ def save_photo_data(file, file_name, delete_local=True):
         background.paste(img, mask=alpha)
         img = background
     # Save smaller image
-    img.thumbnail((700,700))
-    img.save(file_name_700, 'jpeg') 
+    with tracing.span('pillow.thumbnail', size=700):
+        img.thumbnail((700,700))
+        img.save(file_name_700, 'jpeg') 
     # Upload small image to AWS
-    with open(file_name_700, 'rb') as data:
+    with open(file_name_700, 'rb') as data, tracing.span('s3.put_object', key=file_name):
         s3.Bucket(app.config['LOGS_PHOTO_BUCKET_NAME']).put_object(Key=file_name, Body=data)
     # Resize to tiny thumbnail size
-    img.thumbnail((32,32))
-    img.save(file_name_32, 'jpeg') 
+    with tracing.span('pillow.thumbnail', size=32):
+        img.thumbnail((32,32))
+        img.save(file_name_32, 'jpeg') 
     # Delete large local files
     if delete_local:
         os.remove(file_name_original)
         os.remove(file_name_700)
 
+@tracing.traced
 def get_photo_exif(file_name):
     # Save file
     file_name_original = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
@@ -352,18 +376,83 @@ def delete_photo(photo, commit=True):
     # Get food entries that reference this photo and remove the reference
     db.session.delete(photo)
     db.session.flush()
+    versions.bump_version('photos', photo.user_id)
+    versions.bump_version('food', photo.user_id)
     if commit:
         db.session.commit()
 
 
+FOOD101_CHECKPOINT = '/home/howardh/checkpoints/checkpoint-6.pt'
+
+@tracing.traced
 def predict_food_name_from_photo(photo_id):
-    checkpoint_filename = '/home/howardh/checkpoints/checkpoint-6.pt'
     photo_filename = get_photo_file_name(photo_id, size=700)
-    return tracker_data.food101.train.evaluate_image(checkpoint_filename, photo_filename)
+    return tracker_data.food101.train.evaluate_image(FOOD101_CHECKPOINT, photo_filename)
+
+def autogroup_photos(photos, max_gap=datetime.timedelta(minutes=30)):
+    """ Group photos that were probably taken of the same meal.
+    Photos that share a `group_id` are always grouped together. Otherwise,
+    photos taken on the same date less than `max_gap` apart are grouped
+    together. Photos without a time are each given their own group.
 
-def autogoup_photos(photo_ids):
-    # Group by time taken and photo similarity
-    pass
+    Returns a list of lists of photos.
+    """
+    groups = []
+    explicit_groups = {}
+    timed = []
+    for p in photos:
+        if p.group_id is not None:
+            if p.group_id not in explicit_groups:
+                explicit_groups[p.group_id] = []
+                groups.append(explicit_groups[p.group_id])
+            explicit_groups[p.group_id].append(p)
+        elif p.time is None or p.date is None:
+            groups.append([p])
+        else:
+            timed.append(p)
+    timed = sorted(timed, key=lambda p: (p.date, p.time))
+    last_time = None
+    for p in timed:
+        time = datetime.datetime.combine(p.date, p.time)
+        if last_time is None or time-last_time > max_gap:
+            groups.append([])
+        groups[-1].append(p)
+        last_time = time
+    return groups
+
+@tracing.traced
+def classify_photo_groups(groups):
+    """ Return a food name (or `None`) for each group of photos.
+    All photos are classified in a single batched forward pass, and the scores
+    are averaged over the photos in each group.
+    """
+    from fitnessapp.ml import image_classifier
+
+    images = []
+    image_groups = []
+    for i,group in enumerate(groups):
+        for p in group:
+            try:
+                file_name = get_local_photo_file_name(p, size=700)
+                # Read the pixels now so the file is closed before the next one is opened
+                with Image.open(file_name) as img:
+                    img.load()
+                images.append(img)
+                image_groups.append(i)
+            except Exception:
+                print('Unable to load photo %d for classification.' % p.id)
+    names = [None]*len(groups)
+    if len(images) == 0:
+        return names
+    with tracing.span('classifier.predict_scores', images=len(images)):
+        scores = image_classifier.predict_scores(images)
+    image_groups = np.array(image_groups)
+    for i in range(len(groups)):
+        group_scores = scores[image_groups == i]
+        if len(group_scores) == 0:
+            continue
+        names[i] = image_classifier.scores_to_food_name(group_scores.mean(axis=0))
+    return names
 
 def autogenerate_food_entry(photos):
     """ Given a list of photos, create a food entry to go with it """
@@ -391,9 +480,65 @@ def autogenerate_food_entry(photos):
     for p in photos:
         p.food_id = food.id
     db.session.flush()
+    versions.bump_version('food', user_id)
+    versions.bump_version('photos', user_id)
     db.session.commit()
+    food_context.update_entries(user_id, [food])
     print('Creating food entry', food.id)
 
-def autogenerate_food_entry_for_date(date):
-    # TODO
-    pass
+@tracing.traced
+def autogenerate_food_entry_for_date(date, user_id, commit=True):
+    """ Create food entries for all of a user's photos on the given date that are not associated with a food entry yet.
+    Photos are grouped with `autogroup_photos` and each group becomes one food entry. All entries are created in a single transaction.
+
+    Returns the list of created food entries.
+    """
+    photos = db.session.query(Photo) \
+            .filter_by(user_id=user_id) \
+            .filter_by(date=date) \
+            .filter(Photo.food_id.is_(None)) \
+            .order_by(Photo.id) \
+            .all()
+    if len(photos) == 0:
+        return []
+
+    groups = autogroup_photos(photos)
+    names = classify_photo_groups(groups)
+
+    foods = []
+    for group,name in zip(groups,names):
+        food = Food()
+        food.name = name if name is not None else 'Unknown'
+        food.date = group[0].date
+        food.user_id = user_id
+        if len(group) == 1:
+            food.photo_id = group[0].id
+        db.session.add(food)
+        foods.append(food)
+    db.session.flush()
+    for food,group in zip(foods,groups):
+        for p in group:
+            p.food_id = food.id
+    db.session.flush()
+    versions.bump_version('food', user_id)
+    versions.bump_version('photos', user_id)
+
+    if commit:
+        db.session.commit()
+        food_context.update_entries(user_id, foods)
+    print('Created %d food entries for %s' % (len(foods), date))
+    return foods
+
+def autogenerate_food_entries(user_id, dates):
+    """ Run `autogenerate_food_entry_for_date` over many dates, committing once per date.
+    Meant to be run as an offline job. Returns a dictionary mapping each date to the number of entries created.
+    """
+    created = {}
+    for date in dates:
+        try:
+            created[date] = len(autogenerate_food_entry_for_date(date, user_id))
+        except Exception as e:
+            db.session.rollback()
+            print('Failed to autogenerate entries for %s: %s' % (date, e))
+            created[date] = None
+    return created
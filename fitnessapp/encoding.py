@@ -0,0 +1,106 @@
+""" Response encoding.
+
+Resources are serialized with orjson when it is installed, falling back to the
+standard library otherwise. Both handle dates, times, Decimals and enums.
+Clients that prefer `application/msgpack` in their Accept header get
+MessagePack instead, if the msgpack package is installed.
+
+`stream_entities` writes an `entities` response one entity at a time, for
+endpoints that can return a user's full history.
+"""
+import datetime
+import decimal
+import enum
+import json
+
+from flask import Response, request, stream_with_context
+import flask_restful
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ['application/msgpack', 'application/x-msgpack']
+STREAM_CHUNK_SIZE = 64*1024
+
+def default(obj):
+    """ Encode the types that neither encoder handles natively. """
+    if isinstance(obj, (datetime.date, datetime.time)): # Includes datetime.datetime
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    raise TypeError('Object of type %s is not serializable' % type(obj).__name__)
+
+if orjson is not None:
+    def dumps(data):
+        """ Encode `data` as JSON and return bytes. """
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    _encoder = json.JSONEncoder(default=default, separators=(',', ':'))
+    def dumps(data):
+        """ Encode `data` as JSON and return bytes. """
+        return _encoder.encode(data).encode('utf-8')
+
+def output_json(data, code, headers=None):
+    response = Response(dumps(data), status=code, mimetype=JSON_MIMETYPE)
+    response.headers.extend(headers or {})
+    return response
+
+def output_msgpack(data, code, headers=None):
+    response = Response(msgpack.packb(data, default=default, use_bin_type=True),
+            status=code, mimetype=MSGPACK_MIMETYPES[0])
+    response.headers.extend(headers or {})
+    return response
+
+def prefers_msgpack():
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match([JSON_MIMETYPE]+MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+class Api(flask_restful.Api):
+    """ `flask_restful.Api` using the encoders in this module. """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.representations = {JSON_MIMETYPE: output_json}
+        if msgpack is not None:
+            for mimetype in MSGPACK_MIMETYPES:
+                self.representations[mimetype] = output_msgpack
+
+def _generate_entities(entity_type, entities):
+    yield b'{"entities":{' + dumps(entity_type) + b':{'
+    chunk = []
+    size = 0
+    separator = b''
+    for key, value in entities:
+        item = separator + dumps(str(key)) + b':' + dumps(value)
+        separator = b','
+        chunk.append(item)
+        size += len(item)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b'}}}')
+    yield b''.join(chunk)
+
+def stream_entities(entity_type, entities, headers=None):
+    """ Respond with `{'entities': {entity_type: {key: value}}}`, encoding each entity as it is produced.
+    `entities` is an iterable of (key, value) pairs, typically a generator over a query. The request context stays available until the iterable is exhausted.
+    Clients asking for MessagePack get a regular, non-streamed response.
+    """
+    if prefers_msgpack():
+        return output_msgpack({'entities': {entity_type: dict(entities)}}, 200, headers)
+    response = Response(stream_with_context(_generate_entities(entity_type, entities)),
+            status=200, mimetype=JSON_MIMETYPE)
+    response.headers.extend(headers or {})
+    return response
@@ -0,0 +1,172 @@
+from collections import defaultdict, Counter
+import threading
+
+from tracker_database import Food
+from fitnessapp.extensions import db
+from fitnessapp.cache import LRUCache
+from fitnessapp import versions
+
+# user_id -> (food version, model). A model is rebuilt when the user's 'food'
+# version no longer matches, so writes made by other worker processes are
+# picked up on the next prediction.
+_models = LRUCache(maxsize=256)
+
+def normalize_name(name):
+    if name is None:
+        return ''
+    return name.strip().lower()
+
+class FoodContextModel(object):
+    """ Co-occurrence statistics over a user's food history.
+
+    Keeps track of which foods are logged under a parent with a given name,
+    and which foods are logged alongside each other under the same parent.
+    The statistics can be updated one entry at a time, so a cached model never
+    needs to be rebuilt from the full history after a write.
+    """
+    def __init__(self):
+        self.names = {}
+        self.parents = {}
+        self.children = defaultdict(set)
+        self.display_names = {}
+        self.name_counts = Counter()
+        self.parent_counts = defaultdict(Counter)
+        self.sibling_counts = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def _count(self, counts, key, name, delta):
+        if key == '' or name == '':
+            return
+        counts[key][name] += delta
+        if counts[key][name] <= 0:
+            del counts[key][name]
+            if len(counts[key]) == 0:
+                del counts[key]
+
+    def _count_siblings(self, a, b, delta):
+        self._count(self.sibling_counts, self.names[a], self.names[b], delta)
+        self._count(self.sibling_counts, self.names[b], self.names[a], delta)
+
+    def add(self, food_id, parent_id, name):
+        """ Add a food entry to the statistics. """
+        norm = normalize_name(name)
+        self.names[food_id] = norm
+        self.parents[food_id] = parent_id
+        if norm != '':
+            self.name_counts[norm] += 1
+            self.display_names[norm] = name.strip()
+        if parent_id is not None:
+            if parent_id in self.names:
+                self._count(self.parent_counts, self.names[parent_id], norm, 1)
+            for sibling_id in self.children[parent_id]:
+                self._count_siblings(sibling_id, food_id, 1)
+            self.children[parent_id].add(food_id)
+        for child_id in self.children.get(food_id, []):
+            self._count(self.parent_counts, norm, self.names[child_id], 1)
+
+    def remove(self, food_id):
+        """ Remove a food entry from the statistics. Does nothing if the entry is unknown. """
+        if food_id not in self.names:
+            return
+        for child_id in self.children.get(food_id, []):
+            self._count(self.parent_counts, self.names[food_id], self.names[child_id], -1)
+        parent_id = self.parents[food_id]
+        if parent_id is not None:
+            self.children[parent_id].discard(food_id)
+            for sibling_id in self.children[parent_id]:
+                self._count_siblings(sibling_id, food_id, -1)
+            if len(self.children[parent_id]) == 0:
+                del self.children[parent_id]
+            if parent_id in self.names:
+                self._count(self.parent_counts, self.names[parent_id], self.names[food_id], -1)
+        norm = self.names.pop(food_id)
+        del self.parents[food_id]
+        if norm != '':
+            self.name_counts[norm] -= 1
+            if self.name_counts[norm] <= 0:
+                del self.name_counts[norm]
+
+    def predict(self, parent_name=None, sibling_names=[], limit=5):
+        """ Return the names of the foods most likely to appear under a parent with the given name and alongside the given siblings. """
+        parent_name = normalize_name(parent_name)
+        sibling_names = [normalize_name(s) for s in sibling_names]
+        scores = Counter()
+        if parent_name in self.parent_counts:
+            scores.update(self.parent_counts[parent_name])
+        for s in sibling_names:
+            if s in self.sibling_counts:
+                scores.update(self.sibling_counts[s])
+        if len(scores) == 0:
+            scores = self.name_counts
+        excluded = set(sibling_names+[parent_name])
+        predictions = []
+        for name,_ in scores.most_common():
+            if name in excluded:
+                continue
+            predictions.append(self.display_names[name])
+            if len(predictions) >= limit:
+                break
+        return predictions
+
+def get_model(user_id):
+    """ Return the context model for the given user, building it from the user's food history if it is not cached. """
+    user_id = int(user_id)
+    version = versions.get_version('food', user_id)
+    cached = _models.get(user_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    foods = db.session.query(Food) \
+            .with_entities(
+                    Food.id,
+                    Food.parent_id,
+                    Food.name
+            ) \
+            .filter_by(user_id=user_id) \
+            .all()
+    model = FoodContextModel()
+    for food_id, parent_id, name in foods:
+        model.add(food_id, parent_id, name)
+    _models.set(user_id, (version, model))
+    return model
+
+def _update_model(user_id, update):
+    """ Apply `update` to the cached model of a user whose food entries were just changed by this process.
+    The model is kept only if that change was the only one since it was built. Otherwise it is dropped and rebuilt on the next prediction.
+    """
+    user_id = int(user_id)
+    cached = _models.get(user_id)
+    if cached is None:
+        return
+    version, model = cached
+    current_version = versions.get_version('food', user_id)
+    if current_version != version+1:
+        _models.pop(user_id)
+        return
+    with model.lock:
+        update(model)
+    _models.set(user_id, (current_version, model))
+
+def predict(user_id, parent_name=None, sibling_names=[]):
+    model = get_model(user_id)
+    with model.lock:
+        return model.predict(parent_name, sibling_names)
+
+def update_entries(user_id, foods):
+    """ Update a cached model with food entries that were created or modified.
+    Must be called after the changes are committed.
+    """
+    def update(model):
+        for f in foods:
+            model.remove(f.id)
+        for f in foods:
+            model.add(f.id, f.parent_id, f.name)
+    _update_model(user_id, update)
+
+def remove_entries(user_id, food_ids):
+    """ Update a cached model with food entries that were deleted.
+    Must be called after the changes are committed.
+    """
+    def update(model):
+        for food_id in food_ids:
+            model.remove(food_id)
+    _update_model(user_id, update)
@@ -0,0 +1,191 @@
+""" In-process metrics.
+
+Each worker process keeps its own counters, gauges and histograms. They are
+exposed by the local-only `/metrics` endpoint in the Prometheus text format
+(or as JSON with `?format=json`), so a scrape reports on whichever worker
+handled it (see the `pid` field of the JSON output).
+"""
+from collections import OrderedDict
+from functools import wraps
+import bisect
+import json
+import os
+import threading
+
+from flask import request
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+_lock = threading.Lock()
+_metrics = OrderedDict()
+_collectors = []
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def samples(self):
+        """ Return a list of (labels, value) pairs. """
+        with _lock:
+            return [(dict(k), v) for k,v in self.values.items()]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0)+amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_labels_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        """ Increment the gauge and return its new value. """
+        key = _labels_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0)+amount
+            return self.values[key]
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_max(self, value, **labels):
+        """ Set the gauge to `value` if it is larger than the current value. """
+        key = _labels_key(labels)
+        with _lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        with _lock:
+            if key not in self.values:
+                self.values[key] = {
+                    'buckets': [0]*(len(self.buckets)+1),
+                    'sum': 0.,
+                    'count': 0
+                }
+            v = self.values[key]
+            v['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            v['sum'] += value
+            v['count'] += 1
+
+    def samples(self):
+        with _lock:
+            return [(dict(k), {
+                'buckets': list(v['buckets']),
+                'sum': v['sum'],
+                'count': v['count']
+            }) for k,v in self.values.items()]
+
+def _get_or_create(cls, name, *args, **kwargs):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, *args, **kwargs)
+        metric = _metrics[name]
+    if not isinstance(metric, cls):
+        raise Exception('Metric %s already exists with type %s.' % (name, metric.type))
+    return metric
+
+def counter(name, description):
+    return _get_or_create(Counter, name, description)
+
+def gauge(name, description):
+    return _get_or_create(Gauge, name, description)
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, description, buckets)
+
+def register_collector(collector):
+    """ Register a function that is called whenever metrics are read. It returns a list of (name, description, labels, value) tuples, which are reported as gauges. """
+    _collectors.append(collector)
+
+def collect():
+    """ Return all metrics as a list of (name, type, description, samples) tuples. """
+    results = [(m.name, m.type, m.description, m.samples()) for m in list(_metrics.values())]
+    for collector in _collectors:
+        try:
+            for name, description, labels, value in collector():
+                results.append((name, 'gauge', description, [(labels, value)]))
+        except Exception as e:
+            print('Metrics collector failed: %s' % e)
+    return results
+
+def to_dict():
+    output = {'pid': os.getpid(), 'metrics': {}}
+    for name, type, description, samples in collect():
+        output['metrics'][name] = {
+            'type': type,
+            'samples': [{'labels': labels, 'value': value} for labels,value in samples]
+        }
+    return output
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k,v in sorted(labels.items()))
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value))
+
+def to_prometheus():
+    """ Return all metrics in the Prometheus text exposition format. """
+    lines = []
+    for name, type, description, samples in collect():
+        lines.append('# HELP %s %s' % (name, _escape(description)))
+        lines.append('# TYPE %s %s' % (name, type))
+        for labels, value in samples:
+            if type != 'histogram':
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                continue
+            bounds = _metrics[name].buckets+[float('inf')]
+            cumulative = 0
+            for bound, count in zip(bounds, value['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(dict(labels, le=le)), cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(value['sum'])))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), value['count']))
+    return '\n'.join(lines)+'\n'
+
+def local_only(f):
+    """ Only allow requests coming from the machine the app is running on. """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            return json.dumps({'error': 'Not found'}), 404
+        return f(*args, **kwargs)
+    return wrapper
+
+@local_only
+def metrics_endpoint():
+    """ Metrics in the Prometheus text format, or as JSON with `?format=json`. """
+    if request.args.get('format') == 'json':
+        return json.dumps(to_dict()), 200, {'Content-Type': 'application/json'}
+    return to_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+def init_app(app):
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -61,32 +61,59 @@ food_classes = {
     987: 'corn'
 }
 
-#inception = models.inception_v3(pretrained=True)
-resnet = models.resnet18(pretrained=True)
-resnet.eval()
-
-n = 299
-n = 224
-#file_name = '/home/howardh/data/uploads/Cat03.jpg'
-#file_name = '/home/howardh/data/uploads/875806_R.jpg'
-file_name = '/home/howardh/data/uploads/Eq_it-na_pizza-margherita_sep2005_sml.jpg'
-img = Image.open(file_name)
-img = img.resize((n,n))
-img = np.array(img)/255
+input_size = 224
 normalize = torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-img = normalize(torch.from_numpy(img))
-img = img.permute([2,0,1]).view(-1,3,n,n).float()
-#x = inception(torch.cat([img,img],dim=0))
-x = resnet(img)
-scores = x[0].detach().numpy()
-indices = np.argsort(scores) # Descending order, so look at the last entry
-top_5 = indices[-5:]
 
-for i in top_5:
-    if i in food_classes:
-        print(food_classes[i])
-        break
-else:
-    print('None found')
+_model = None
+
+def get_model():
+    """ Return the pretrained classifier, loading it on first use. """
+    global _model
+    if _model is None:
+        #_model = models.inception_v3(pretrained=True)
+        _model = models.resnet18(pretrained=True)
+        _model.eval()
+    return _model
+
+def preprocess(img, n=input_size):
+    """ Convert a PIL image to a normalized tensor of shape (3,n,n). """
+    img = img.convert('RGB').resize((n,n))
+    img = np.array(img)/255
+    img = torch.from_numpy(img).permute([2,0,1]).float()
+    return normalize(img)
+
+def predict_scores(images, model=None):
+    """ Run a single batched forward pass over a list of PIL images.
+    Returns an array of shape (len(images), 1000) with the scores for each ImageNet class.
+    """
+    if model is None:
+        model = get_model()
+    batch = torch.stack([preprocess(img) for img in images])
+    with torch.no_grad():
+        x = model(batch)
+    return x.numpy()
+
+def scores_to_food_name(scores, top_k=5):
+    """ Return the name of the highest-scoring food class among the top `top_k` classes, or `None` if none of them are food. """
+    indices = np.argsort(scores) # Ascending order, so look at the last entries
+    for i in reversed(indices[-top_k:]):
+        if i in food_classes:
+            return food_classes[i]
+    return None
+
+def classify(images, model=None):
+    """ Return a food name (or `None`) for each image in a list of PIL images. """
+    return [scores_to_food_name(s) for s in predict_scores(images, model)]
+
+if __name__ == '__main__':
+    #file_name = '/home/howardh/data/uploads/Cat03.jpg'
+    #file_name = '/home/howardh/data/uploads/875806_R.jpg'
+    file_name = '/home/howardh/data/uploads/Eq_it-na_pizza-margherita_sep2005_sml.jpg'
+    img = Image.open(file_name)
+    name = classify([img])[0]
+    if name is not None:
+        print(name)
+    else:
+        print('None found')
 
 # See https://discuss.pytorch.org/t/pretrained-resnet-constant-output/2760/8
@@ -0,0 +1,81 @@
+""" Tables owned by the backend itself.
+Most models live in `tracker_database`. These share its metadata (see
+`fitnessapp.extensions`), so `db.create_all()` creates them alongside the
+rest of the schema.
+"""
+from tracker_database import WorkoutSet
+from fitnessapp.extensions import db
+
+class BodyweightHourlyStats(db.Model):
+    """ Running mean and sum of squared deviations (Welford's M2) of a user's bodyweight for one hour of the day. """
+    __tablename__ = 'bodyweight_hourly_stats'
+    user_id = db.Column(db.Integer, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    mean = db.Column(db.Float, nullable=False, default=0)
+    m2 = db.Column(db.Float, nullable=False, default=0)
+
+class BodyweightDailyStats(db.Model):
+    """ Number of entries and sum of bodyweights logged by a user on one date, over all entries and over the entries that have a time.
+    These are sufficient statistics for a least-squares fit of bodyweight against date over any range of days.
+    """
+    __tablename__ = 'bodyweight_daily_stats'
+    user_id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0)
+    timed_count = db.Column(db.Integer, nullable=False, default=0)
+    timed_total = db.Column(db.Float, nullable=False, default=0)
+
+class EntityVersion(db.Model):
+    """ A counter that is incremented whenever a type of entity is modified, used to build ETags.
+    Global entities (e.g. the exercise catalog) use a `user_id` of 0.
+    """
+    __tablename__ = 'entity_versions'
+    user_id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class PasswordAttempts(db.Model):
+    """ Number of password attempts made from one address during the minute starting at `window_start`. Shared by every process, unlike an in-memory counter. """
+    __tablename__ = 'password_attempts'
+    key = db.Column(db.String, primary_key=True)
+    window_start = db.Column(db.DateTime, nullable=False, index=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class ExerciseDailyRollup(db.Model):
+    """ Totals and best set for one exercise performed by a user on one date. """
+    __tablename__ = 'exercise_daily_rollups'
+    user_id = db.Column(db.Integer, primary_key=True)
+    exercise_id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    sets = db.Column(db.Integer, nullable=False, default=0)
+    reps = db.Column(db.Integer, nullable=False, default=0)
+    duration = db.Column(db.Float, nullable=False, default=0)
+    best_reps = db.Column(db.Integer)
+    best_duration = db.Column(db.Float)
+
+    def to_dict(self):
+        return {
+            'exercise_id': self.exercise_id,
+            'date': str(self.date),
+            'sets': self.sets,
+            'reps': self.reps,
+            'duration': self.duration,
+            'best_reps': self.best_reps,
+            'best_duration': self.best_duration
+        }
+
+class TagClosure(db.Model):
+    """ Closure table over the `parent_id` hierarchy of tags. There is one row for every (ancestor, descendant) pair, including each tag paired with itself at depth 0. """
+    __tablename__ = 'tag_closure'
+    ancestor_id = db.Column(db.Integer, primary_key=True)
+    descendant_id = db.Column(db.Integer, primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+# WorkoutSet is defined in tracker_database, so its index is declared here.
+# `db.create_all()` does not add indexes to tables that already exist. On an
+# existing database, run `workout_set_user_date_order_index.create(db.engine)`.
+workout_set_user_date_order_index = db.Index(
+        'ix_workout_set_user_id_date_order',
+        WorkoutSet.user_id, WorkoutSet.date, WorkoutSet.order)
@@ -0,0 +1,162 @@
+""" Password hashing with a global cap on concurrent hashes.
+
+bcrypt at cost 12 takes around 250ms of CPU, during which the request's
+worker can do nothing else. To keep a burst of logins from tying up every
+worker, at most `PASSWORD_HASH_MAX_CONCURRENT` hashes run at once across all
+processes, and each address is limited to `PASSWORD_ATTEMPTS_PER_MINUTE`
+attempts. Both limits are kept in the database (a Postgres advisory lock per
+slot, taken on the request's own connection, and the `password_attempts`
+table), so they hold no matter how many processes or machines serve requests.
+
+Hashes are computed in a per-process pool of `PASSWORD_HASH_WORKERS`
+processes. Setting it to 0 computes them inline, which avoids the round trip
+to the pool when each worker serves one request at a time, as with uwsgi's
+process-per-request setup (see app.ini). On AWS Lambda (zappa), where
+multiprocessing is unavailable, the pool cannot start and hashes run inline.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import datetime
+import os
+import random
+import threading
+import time
+
+import bcrypt
+from flask import current_app as app
+from sqlalchemy import func, select, case
+from sqlalchemy.dialects.postgresql import insert
+
+from fitnessapp import metrics
+from fitnessapp.extensions import db
+from fitnessapp.models import PasswordAttempts
+
+BCRYPT_ROUNDS = 12
+# First key of the advisory locks used as hashing slots. The second key is the slot number.
+LOCK_CLASS = 0x62637279
+LOCK_POLL_INTERVAL = 0.05
+
+hash_seconds = metrics.histogram('password_hash_seconds', 'Time spent computing a bcrypt hash or check.')
+queue_wait_seconds = metrics.histogram('password_hash_queue_wait_seconds', 'Time a hash or check waited for a free slot before being computed.')
+rejections = metrics.counter('password_hash_rejected_total', 'Number of password operations rejected by the concurrency cap or rate limit.')
+
+class PasswordHashBusy(Exception):
+    """ Raised when too many password operations are already running. """
+    pass
+
+class TooManyAttempts(Exception):
+    """ Raised when a client has made too many password attempts recently. """
+    pass
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+def _get_executor():
+    """ Return this process's pool, or `None` if hashes should run inline.
+    The pool is created on first use so each uwsgi worker gets its own after forking.
+    """
+    global _executor, _executor_pid
+    workers = app.config.get('PASSWORD_HASH_WORKERS', 1)
+    if workers <= 0:
+        return None
+    with _lock:
+        if _executor_pid != os.getpid():
+            _executor_pid = os.getpid()
+            try:
+                _executor = ProcessPoolExecutor(max_workers=workers)
+            except (ImportError, NotImplementedError, OSError) as e:
+                # e.g. no /dev/shm on Lambda
+                print('Unable to start the password hashing pool, hashing inline: %s' % e)
+                _executor = None
+        return _executor
+
+def _reset_executor():
+    global _executor_pid
+    with _lock:
+        _executor_pid = None
+
+def _hashpw(password, rounds):
+    start = time.perf_counter()
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    return hashed, time.perf_counter()-start
+
+def _checkpw(password, hashed):
+    start = time.perf_counter()
+    result = bcrypt.checkpw(password, hashed)
+    return result, time.perf_counter()-start
+
+def _acquire_slot(connection, slots, timeout):
+    """ Take one of the `slots` advisory locks on the given connection. Returns the slot number, or `None` if none was free within `timeout` seconds. """
+    deadline = time.monotonic()+timeout
+    while True:
+        for slot in range(slots):
+            if connection.execute(select([func.pg_try_advisory_lock(LOCK_CLASS, slot)])).scalar():
+                return slot
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(LOCK_POLL_INTERVAL)
+
+def _run(operation, fn, *args):
+    slots = app.config.get('PASSWORD_HASH_MAX_CONCURRENT', 4)
+    timeout = app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 5)
+    start = time.perf_counter()
+    # The lock is taken on the request's own connection rather than an extra one from the pool.
+    # Advisory locks belong to the connection, so they are released if this process dies.
+    connection = db.session.connection()
+    slot = _acquire_slot(connection, slots, timeout)
+    if slot is None:
+        rejections.inc(reason='busy')
+        raise PasswordHashBusy('Server too busy. Try again later.')
+    try:
+        executor = _get_executor()
+        if executor is None:
+            result, elapsed = fn(*args)
+        else:
+            try:
+                result, elapsed = executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                _reset_executor()
+                raise
+    finally:
+        connection.execute(select([func.pg_advisory_unlock(LOCK_CLASS, slot)]))
+    hash_seconds.observe(elapsed, operation=operation)
+    queue_wait_seconds.observe(time.perf_counter()-start-elapsed, operation=operation)
+    return result
+
+def check_rate_limit(key):
+    """ Record an attempt for the given key (e.g. an IP address) and raise `TooManyAttempts` if it has made too many in the current minute.
+    The attempt is committed on its own connection, so it counts even if the request's transaction is rolled back.
+    """
+    limit = app.config.get('PASSWORD_ATTEMPTS_PER_MINUTE', 10)
+    table = PasswordAttempts.__table__
+    window_start = func.date_trunc('minute', func.timezone('UTC', func.now()))
+    statement = insert(table) \
+            .values(key=key, window_start=window_start, count=1) \
+            .on_conflict_do_update(
+                    index_elements=[table.c.key],
+                    set_={
+                        'window_start': window_start,
+                        'count': case(
+                            [(table.c.window_start == window_start, table.c.count+1)],
+                            else_=1)
+                    }
+            ) \
+            .returning(table.c.count)
+    with db.engine.begin() as connection:
+        count = connection.execute(statement).scalar()
+        # Occasionally forget addresses that have not been seen in a while
+        if random.random() < 0.01:
+            connection.execute(table.delete() \
+                    .where(table.c.window_start < func.timezone('UTC', func.now())-datetime.timedelta(hours=1)))
+    if count > limit:
+        rejections.inc(reason='rate_limit')
+        raise TooManyAttempts('Too many attempts. Try again later.')
+
+def hash_password(password):
+    """ Return the bcrypt hash of a password given as a string. """
+    return _run('hash', _hashpw, password.encode('utf-8'), BCRYPT_ROUNDS)
+
+def check_password(password, hashed):
+    """ Check a password given as a string against a bcrypt hash. """
+    return _run('check', _checkpw, password.encode('utf-8'), hashed)
@@ -0,0 +1,114 @@
+""" Per-endpoint latency and SQL cost.
+
+Every request records its latency, number of SQL statements, time spent in
+the database and response size, labelled by route and method. Requests that
+run more than `METRICS_QUERY_THRESHOLD` statements are counted and logged, as
+they usually mean a query is being run once per row. Streamed responses are
+recorded once they have been sent.
+"""
+import time
+
+from flask import g, request, has_request_context
+from flask import current_app as app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from fitnessapp import metrics
+
+QUERY_COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+request_seconds = metrics.histogram('http_request_duration_seconds', 'Time taken to handle a request.')
+requests_total = metrics.counter('http_requests_total', 'Number of requests handled.')
+response_bytes = metrics.counter('http_response_bytes_total', 'Number of bytes in response bodies.')
+queries_per_request = metrics.histogram('db_queries_per_request', 'Number of SQL statements run by a request.', QUERY_COUNT_BUCKETS)
+queries_total = metrics.counter('db_queries_total', 'Number of SQL statements run.')
+query_seconds = metrics.counter('db_query_seconds_total', 'Time spent running SQL statements.')
+over_threshold = metrics.counter('db_query_threshold_exceeded_total', 'Number of requests that ran more SQL statements than METRICS_QUERY_THRESHOLD.')
+
+def _route():
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+def _end_query(conn):
+    elapsed = time.perf_counter()-conn.info['query_start_time'].pop()
+    if has_request_context() and 'request_start_time' in g:
+        g.query_count += 1
+        g.query_time += elapsed
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _end_query(conn)
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # Failed statements never reach after_cursor_execute. Without this, their
+    # start time would be left on the connection for the next statement.
+    conn = context.connection
+    if conn is not None and conn.info.get('query_start_time'):
+        _end_query(conn)
+
+def _before_request():
+    g.request_start_time = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0
+
+def _record(state, labels, status, length, description, threshold):
+    request_seconds.observe(time.perf_counter()-state.request_start_time, **labels)
+    requests_total.inc(status=status, **labels)
+    queries_per_request.observe(state.query_count, **labels)
+    queries_total.inc(state.query_count, **labels)
+    query_seconds.inc(state.query_time, **labels)
+    if length is not None:
+        response_bytes.inc(length, **labels)
+    if state.query_count > threshold:
+        over_threshold.inc(**labels)
+        print('%s ran %d SQL statements (threshold %d)' % (
+            description, state.query_count, threshold))
+
+def _count_bytes(chunks, charset, sent):
+    """ Pass a streamed body through, adding the number of bytes sent to `sent[0]`. """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                sent[0] += len(chunk.encode(charset))
+            else:
+                sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def _after_request(response):
+    if 'request_start_time' not in g:
+        return response
+    labels = {'route': _route(), 'method': request.method}
+    description = '%s %s' % (request.method, request.path)
+    threshold = app.config.get('METRICS_QUERY_THRESHOLD', 20)
+    # Keep a reference to `g`, since it may be gone by the time a streamed response is closed
+    state = g._get_current_object()
+    length = response.content_length
+    if response.is_streamed:
+        # Streamed bodies are generated (and query the database) while they
+        # are sent, so record them once the server has finished sending.
+        if length is None:
+            sent = [0]
+            response.response = _count_bytes(response.response, response.charset, sent)
+            response.call_on_close(lambda: _record(state, labels, response.status_code,
+                    sent[0], description, threshold))
+        else:
+            response.call_on_close(lambda: _record(state, labels, response.status_code,
+                    length, description, threshold))
+    else:
+        if length is None:
+            length = response.calculate_content_length()
+        _record(state, labels, response.status_code, length, description, threshold)
+    return response
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -2,36 +2,30 @@ import flask
 from flask import render_template
 from flask import Blueprint
 from flask import request
+from flask import current_app as app
 from flask import session
 import flask_login
 from flask_login import login_required, current_user, login_user
 
 import json
-import bcrypt
 
 from tracker_database import User
 from fitnessapp.extensions import login_manager, db
+from fitnessapp import user_cache, passwords, tokens
 
 auth_bp = Blueprint('auth', __name__)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.query(User).filter_by(id=user_id).first()
+    return user_cache.get_user(user_id)
 
 @login_manager.request_loader
 def request_loader(request):
-    email = request.form.get('email')
-    password = request.form.get('password')
-    if email is None or password is None:
-        return
-
-    user = db.session.query(User).filter_by(email=email)
-    if user is None:
-        return
-    user.authenticated = password == user.password
-    print(user.id)
-
-    return user
+    """ Authenticate API clients from an `Authorization: Bearer <token>` header. """
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    return tokens.load_token(header[len('Bearer '):].strip())
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
@@ -63,6 +57,10 @@ def login():
           properties:
             error:
               type: string
+      429:
+        description: Too many login attempts from this address
+      503:
+        description: Too many password checks in progress
     """
     data = request.get_json()
     email = data['email']
@@ -70,16 +68,119 @@ def login():
     if 'permanent' in data:
         permanent = data['permanent']
         session.permanent = permanent
+    try:
+        passwords.check_rate_limit(request.remote_addr)
+    except passwords.TooManyAttempts as e:
+        return json.dumps({'error': str(e)}), 429
     user = db.session.query(User).filter_by(email=email).first()
     if user is None:
         return json.dumps({'error': "Incorrect email/password"}), 403
-    if bcrypt.checkpw(data['password'].encode('utf-8'), user.password.tobytes()):
+    try:
+        correct = passwords.check_password(data['password'], user.password.tobytes())
+    except passwords.PasswordHashBusy as e:
+        return json.dumps({'error': str(e)}), 503
+    if correct:
         flask_login.login_user(user)
         print("successful login")
         return json.dumps(user.id), 200
     print("failed login")
     return json.dumps({'error': 'Bad login'}), 403
 
+@auth_bp.route('/token', methods=['POST'])
+def create_token():
+    """ Get a bearer token for API clients.
+    The token is sent in an `Authorization: Bearer <token>` header. It expires after `API_TOKEN_MAX_AGE` seconds, or when the user's password is changed.
+    ---
+    tags:
+      - auth
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            email:
+              type: string
+              example: 'name@email.com'
+            password:
+              type: string
+    responses:
+      200:
+        schema:
+          type: object
+          properties:
+            token:
+              type: string
+            expires_in:
+              type: number
+      403:
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+      429:
+        description: Too many login attempts from this address
+      503:
+        description: Too many password checks in progress
+    """
+    data = request.get_json()
+    try:
+        passwords.check_rate_limit(request.remote_addr)
+    except passwords.TooManyAttempts as e:
+        return json.dumps({'error': str(e)}), 429
+    user = db.session.query(User).filter_by(email=data['email']).first()
+    if user is None:
+        return json.dumps({'error': "Incorrect email/password"}), 403
+    try:
+        correct = passwords.check_password(data['password'], user.password.tobytes())
+    except passwords.PasswordHashBusy as e:
+        return json.dumps({'error': str(e)}), 503
+    if not correct:
+        return json.dumps({'error': "Incorrect email/password"}), 403
+    return json.dumps({
+        'token': tokens.issue_token(user.id),
+        'expires_in': app.config.get('API_TOKEN_MAX_AGE', 60*60*24*7)
+    }), 200
+
+@auth_bp.route('/token/revoke', methods=['POST'])
+@login_required
+def revoke_token():
+    """ Revoke the bearer token used to make this request.
+    With `all` set, every token issued to the user is revoked instead.
+    ---
+    tags:
+      - auth
+    parameters:
+      - in: body
+        name: body
+        schema:
+          type: object
+          properties:
+            all:
+              type: boolean
+    responses:
+      200:
+        schema:
+          type: object
+      400:
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+    """
+    data = request.get_json(silent=True) or {}
+    if data.get('all'):
+        tokens.revoke_all(current_user.get_id())
+        db.session.commit()
+        return '{}', 200
+    if not isinstance(current_user._get_current_object(), tokens.TokenUser):
+        return json.dumps({'error': 'Request was not authenticated with a token.'}), 400
+    tokens.revoke(current_user)
+    return '{}', 200
+
 @auth_bp.route('/current_session', methods=['GET'])
 def get_current_session():
     """ Log in.
@@ -1,6 +1,6 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
@@ -9,19 +9,35 @@ from flasgger import SwaggerView
 
 import datetime
 import os
+import csv
+import json
+import math
 from PIL import Image
 import base64
 from io import BytesIO
 import numpy as np
 
-import tracker_data
-import tracker_data.bodyweight
-from tracker_database import Bodyweight, UserProfile, WeightUnitsEnum
+from tracker_database import Bodyweight, WeightUnitsEnum
 from fitnessapp.extensions import db
+from fitnessapp import bodyweight_stats
+from fitnessapp import user_cache
+from fitnessapp import timeseries
+from fitnessapp import versions
+from fitnessapp.cache import LRUCache
+from fitnessapp.encoding import Api
 
 blueprint = Blueprint('body', __name__)
 api = Api(blueprint)
 
+# Downsampled series keyed by (user_id, version, start_date, end_date, points, method, units).
+# The key includes the user's bodyweight version, so a write made by any
+# process is seen on the next request. Entries for older versions are left to
+# expire, except in the process that made the write.
+series_cache = LRUCache(maxsize=512, ttl=5*60)
+
+def invalidate_series_cache(user_id):
+    series_cache.discard_where(lambda key: key[0] == int(user_id))
+
 class BodyweightList(Resource):
     @login_required
     def get(self):
@@ -79,12 +95,7 @@ class BodyweightList(Resource):
                 .limit(10) \
                 .offset(page*10) \
                 .all()
-        units = db.session.query(UserProfile) \
-                .with_entities(
-                        UserProfile.prefered_units
-                )\
-                .filter_by(id=current_user.get_id()) \
-                .one()[0]
+        units = user_cache.get_prefered_units(current_user.get_id())
         multiplier = 1
         if units == WeightUnitsEnum.lbs:
             multiplier = 1/0.45359237
@@ -126,10 +137,13 @@ class BodyweightList(Resource):
                 'error': "Unable to find requested bodyweight entry."
             }, 404
 
+        bodyweight_stats.remove_bodyweights(current_user.get_id(), weights)
         for w in weights:
             db.session.delete(w)
         db.session.flush()
+        versions.bump_version('bodyweight', current_user.get_id())
         db.session.commit()
+        invalidate_series_cache(int(current_user.get_id()))
         return {
             'message': "Deleted successfully",
             'entities': {
@@ -174,12 +188,8 @@ class BodyweightList(Resource):
         """
         data = request.get_json()
         bw = Bodyweight()
-        units = db.session.query(UserProfile) \
-                .with_entities(
-                        UserProfile.prefered_units
-                )\
-                .filter_by(id=current_user.get_id()) \
-                .one()[0]
+        # Stored weights are converted with the current units, not another process's cached copy
+        units = user_cache.get_prefered_units(current_user.get_id(), cached=False)
 
         try:
             bw.bodyweight = float(data['bodyweight'])
@@ -199,11 +209,20 @@ class BodyweightList(Resource):
         if units == WeightUnitsEnum.lbs:
             bw.bodyweight *= 0.45359237
 
-        bw.user_id = current_user.get_id()
+        bw.user_id = int(current_user.get_id())
 
         db.session.add(bw)
         db.session.flush()
+        try:
+            bodyweight_stats.add_bodyweights(bw.user_id, [bw])
+        except ValueError as e:
+            db.session.rollback()
+            return {
+                'error': str(e)
+            }, 400
+        versions.bump_version('bodyweight', bw.user_id)
         db.session.commit()
+        invalidate_series_cache(bw.user_id)
 
         data['id'] = bw.id
 
@@ -252,9 +271,12 @@ class Bodyweights(Resource):
                 'error': "Unable to find requested bodyweight entry."
             }, 404
 
+        bodyweight_stats.remove_bodyweights(weight.user_id, [weight])
         db.session.delete(weight)
         db.session.flush()
+        versions.bump_version('bodyweight', weight.user_id)
         db.session.commit()
+        invalidate_series_cache(weight.user_id)
         return {
             'message': "Deleted successfully",
             'entities': {
@@ -262,6 +284,397 @@ class Bodyweights(Resource):
             }
         }, 200
 
+def read_import_rows(lines, format):
+    """ Parse lines of a bodyweight import, given as bytes. Yields `(line_number, row)` tuples where `row` is either a dictionary with `date`, `time` and `bodyweight` keys, or an exception if the line could not be read. """
+    # Lines that are not valid UTF-8 are replaced with blank lines and reported as errors
+    invalid = {}
+    def decode(lines):
+        for line_number,line in enumerate(lines, start=1):
+            try:
+                yield line.decode('utf-8')
+            except UnicodeDecodeError as e:
+                invalid[line_number] = ValueError('Invalid UTF-8: %s' % e)
+                yield '\n'
+    lines = decode(lines)
+    if format == 'csv':
+        reader = csv.reader(lines)
+        columns = None
+        next_line_number = 1
+        for fields in reader:
+            # A quoted field can span several lines, so records are numbered by the line they start on
+            line_number, next_line_number = next_line_number, reader.line_num+1
+            bad_lines = [n for n in range(line_number, next_line_number) if n in invalid]
+            if len(bad_lines) > 0:
+                for n in bad_lines:
+                    yield n, invalid.pop(n)
+                continue
+            if len(fields) == 0:
+                continue
+            if columns is None:
+                header = [f.strip().lower() for f in fields]
+                if 'bodyweight' in header:
+                    columns = header
+                    continue
+                columns = ['date', 'time', 'bodyweight']
+            if len(fields) != len(columns):
+                yield line_number, ValueError('Expected %d fields, found %d.' % (len(columns), len(fields)))
+                continue
+            yield line_number, dict(zip(columns, [f.strip() for f in fields]))
+    else:
+        for line_number,line in enumerate(lines, start=1):
+            if line_number in invalid:
+                yield line_number, invalid.pop(line_number)
+                continue
+            if line.strip() == '':
+                continue
+            try:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError('Expected a JSON object.')
+                yield line_number, row
+            except ValueError as e:
+                yield line_number, e
+
+def parse_import_row(row, multiplier):
+    """ Validate a row from a bodyweight import and return a `(date, time, bodyweight)` tuple with the bodyweight in kilograms. """
+    # JSON rows can hold any type, so check them before they reach the database
+    if 'bodyweight' not in row or row['bodyweight'] in (None, ''):
+        raise ValueError('No bodyweight provided.')
+    if isinstance(row['bodyweight'], bool) or not isinstance(row['bodyweight'], (int, float, str)):
+        raise ValueError('Invalid bodyweight: %s' % json.dumps(row['bodyweight']))
+    bodyweight = float(row['bodyweight'])*multiplier
+    if not math.isfinite(bodyweight):
+        raise ValueError('Invalid bodyweight: %s' % row['bodyweight'])
+    if 'date' not in row or row['date'] in (None, ''):
+        raise ValueError('No date provided.')
+    if not isinstance(row['date'], str):
+        raise ValueError('Invalid date: %s' % json.dumps(row['date']))
+    if row.get('time') is not None and not isinstance(row['time'], str):
+        raise ValueError('Invalid time: %s' % json.dumps(row['time']))
+    date = bodyweight_stats.parse_date(row['date'])
+    time = bodyweight_stats.parse_time(row.get('time'))
+    return date, time, bodyweight
+
+def import_bodyweight_chunk(user_id, chunk):
+    """ Insert a chunk of parsed `(line_number, (date, time, bodyweight))` entries, skipping any that share a (date, time) with an existing entry or with an earlier entry in the chunk.
+    Returns the number of entries inserted.
+    """
+    dates = set([e[0] for _,e in chunk])
+    existing = db.session.query(Bodyweight) \
+            .with_entities(
+                    Bodyweight.date,
+                    Bodyweight.time
+            ) \
+            .filter_by(user_id=user_id) \
+            .filter(Bodyweight.date.in_(list(dates))) \
+            .all()
+    seen = set([tuple(e) for e in existing])
+    entries = []
+    for _,(date,time,bodyweight) in chunk:
+        if (date,time) in seen:
+            continue
+        seen.add((date,time))
+        entries.append((date,time,bodyweight))
+    if len(entries) == 0:
+        return 0
+    db.session.execute(
+        Bodyweight.__table__.insert().values([{
+            'user_id': user_id,
+            'date': date,
+            'time': time,
+            'bodyweight': bodyweight
+        } for date,time,bodyweight in entries])
+    )
+    bodyweight_stats.add_bodyweights(user_id, entries)
+    versions.bump_version('bodyweight', user_id)
+    db.session.commit()
+    invalidate_series_cache(user_id)
+    return len(entries)
+
+class BodyweightImport(Resource):
+    @login_required
+    def post(self):
+        """ Import many bodyweight entries at once.
+        The request body is streamed and inserted in chunks, so it can be arbitrarily large. Entries with the same date and time as an existing entry are skipped. Invalid rows are reported without stopping the import.
+        Each chunk is committed as soon as it is inserted, so the import is not atomic: if the request fails part way through, the entries of the chunks already committed are kept, and importing the same file again skips them as duplicates.
+        ---
+        tags:
+          - body
+        consumes:
+          - text/csv
+          - application/x-ndjson
+        parameters:
+          - in: body
+            name: body
+            required: true
+            description: Either CSV with the columns `date`, `time` and `bodyweight` (a header row is optional), or one JSON object per line with the same keys.
+            schema:
+              type: string
+          - name: units
+            in: query
+            type: string
+            description: Units of the imported bodyweights (`kgs` or `lbs`). Defaults to the user's prefered units.
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                imported:
+                  type: number
+                  description: Number of entries committed.
+                duplicates:
+                  type: number
+                error_count:
+                  type: number
+                errors:
+                  type: array
+                  description: The first 100 errors.
+                  items:
+                    type: object
+                    properties:
+                      line:
+                        type: number
+                      error:
+                        type: string
+        """
+        user_id = int(current_user.get_id())
+        chunk_size = 1000
+        max_errors = 100
+
+        units = request.args.get('units')
+        if units is None:
+            units = user_cache.get_prefered_units(user_id, cached=False)
+        else:
+            try:
+                units = WeightUnitsEnum[units]
+            except KeyError:
+                return {
+                    'error': 'Invalid units: %s' % units
+                }, 400
+        multiplier = 1
+        if units == WeightUnitsEnum.lbs:
+            multiplier = 0.45359237
+
+        if request.mimetype == 'text/csv':
+            format = 'csv'
+        elif request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            format = 'jsonl'
+        else:
+            return {
+                'error': 'Unsupported content type. Use text/csv or application/x-ndjson.'
+            }, 400
+
+        count = 0
+        imported = 0
+        errors = []
+        error_count = 0
+        chunk = []
+        for line_number,row in read_import_rows(request.stream, format):
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                chunk.append((line_number, parse_import_row(row, multiplier)))
+                count += 1
+            except Exception as e:
+                error_count += 1
+                if len(errors) < max_errors:
+                    errors.append({'line': line_number, 'error': str(e)})
+            if len(chunk) >= chunk_size:
+                imported += import_bodyweight_chunk(user_id, chunk)
+                chunk = []
+        if len(chunk) > 0:
+            imported += import_bodyweight_chunk(user_id, chunk)
+
+        return {
+            'message': 'Imported %d bodyweight entries.' % imported,
+            'imported': imported,
+            'duplicates': count-imported,
+            'error_count': error_count,
+            'errors': errors
+        }, 200
+
+class BodyweightSeries(Resource):
+    @login_required
+    def get(self):
+        """ Return the user's bodyweight over a date range, downsampled to a fixed number of points.
+        ---
+        tags:
+          - body
+        parameters:
+          - name: start_date
+            in: query
+            type: string
+            format: date
+            description: First date to include. Defaults to the date of the first entry.
+          - name: end_date
+            in: query
+            type: string
+            format: date
+            description: Last date to include. Defaults to the date of the last entry.
+          - name: points
+            in: query
+            type: number
+            description: Maximum number of points to return. Defaults to 200.
+          - name: method
+            in: query
+            type: string
+            description: Downsampling method. One of `lttb` (default), `mean` or `minmax`.
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                series:
+                  type: object
+                  properties:
+                    units:
+                      type: string
+                    method:
+                      type: string
+                    data:
+                      type: array
+                      description: Pairs of ISO 8601 timestamps and bodyweights, in chronological order.
+                      items:
+                        type: array
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        user_id = int(current_user.get_id())
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        method = request.args.get('method', 'lttb')
+        try:
+            points = int(request.args.get('points', 200))
+            if start_date is not None:
+                start_date = bodyweight_stats.parse_date(start_date)
+            if end_date is not None:
+                end_date = bodyweight_stats.parse_date(end_date)
+        except ValueError as e:
+            return {
+                'error': str(e)
+            }, 400
+        if method not in timeseries.methods:
+            return {
+                'error': 'Unknown method %s. Expected one of %s.' % (method, ', '.join(timeseries.methods.keys()))
+            }, 400
+        points = min(max(points, 3), 5000)
+
+        key = (user_id, versions.get_version('bodyweight', user_id), versions.get_version('profile', user_id),
+                start_date, end_date, points, method)
+        series = series_cache.get(key)
+        if series is None:
+            units = user_cache.get_prefered_units(user_id, cached=False)
+            series = compute_bodyweight_series(user_id, start_date, end_date, points, method, units)
+            series_cache.set(key, series)
+        return {
+            'series': series
+        }, 200
+
+def compute_bodyweight_series(user_id, start_date, end_date, points, method, units):
+    query = db.session.query(Bodyweight) \
+            .with_entities(
+                    Bodyweight.date,
+                    Bodyweight.time,
+                    Bodyweight.bodyweight
+            ) \
+            .filter_by(user_id=user_id) \
+            .filter(Bodyweight.bodyweight.isnot(None))
+    if start_date is not None:
+        query = query.filter(Bodyweight.date >= start_date)
+    if end_date is not None:
+        query = query.filter(Bodyweight.date <= end_date)
+    rows = query \
+            .order_by(Bodyweight.date) \
+            .order_by(Bodyweight.time) \
+            .all()
+
+    # Timestamps are computed as if the dates and times were in UTC so that
+    # they convert back exactly. Entries without a time are placed at midnight.
+    midnight = datetime.time()
+    x = np.fromiter((
+        datetime.datetime.combine(d, t if t is not None else midnight).replace(tzinfo=datetime.timezone.utc).timestamp()
+        for d,t,_ in rows
+    ), dtype=float, count=len(rows))
+    y = np.fromiter((w for _,_,w in rows), dtype=float, count=len(rows))
+    if len(x) > 0:
+        x, y = timeseries.methods[method](x, y, points)
+    if units == WeightUnitsEnum.lbs:
+        y = y/0.45359237
+    return {
+        'start_date': str(start_date) if start_date is not None else None,
+        'end_date': str(end_date) if end_date is not None else None,
+        'units': units.name,
+        'method': method,
+        'data': [
+            [datetime.datetime.utcfromtimestamp(t).isoformat(), float(w)]
+            for t,w in zip(x,y)
+        ]
+    }
+
+def bodyweight_summary_query(user_id):
+    """ Query over the entries used for the bodyweight summary. """
+    return db.session.query(Bodyweight) \
+            .filter_by(user_id=user_id) \
+            .filter(Bodyweight.time.isnot(None)) \
+            .filter(Bodyweight.bodyweight.isnot(None))
+
+def compute_bodyweight_history(user_id, units_scale=1, num_buckets=20):
+    """ Split the user's full history into `num_buckets` evenly-spaced date ranges and return the mean bodyweight in each.
+    The bucketing and averaging is done by the database, so only `num_buckets` rows are returned.
+    """
+    start_date, end_date = bodyweight_summary_query(user_id) \
+            .with_entities(
+                    func.min(Bodyweight.date),
+                    func.max(Bodyweight.date)
+            ) \
+            .one()
+    if start_date is None:
+        return {
+            'start_date': None,
+            'end_date': None,
+            'data': [None]*num_buckets
+        }
+    # Subtracting two dates gives an integer number of days in Postgres.
+    days = Bodyweight.date-start_date
+    span = max((end_date-start_date).days, 1)
+    bucket = func.least(func.width_bucket(days, 0, span, num_buckets), num_buckets)
+    buckets = bodyweight_summary_query(user_id) \
+            .with_entities(
+                    bucket,
+                    func.avg(Bodyweight.bodyweight)
+            ) \
+            .group_by(bucket) \
+            .all()
+    data = [None]*num_buckets
+    for b,mean in buckets:
+        data[b-1] = float(mean)*units_scale
+    return {
+        'start_date': str(start_date),
+        'end_date': str(end_date),
+        'data': data
+    }
+
+def compute_recent_average(user_id, units_scale=1, days=7, min_count=6):
+    """ Compute the mean bodyweight over the last `days` days, extended to the `min_count` most recent entries if there are not enough. """
+    window_count = bodyweight_summary_query(user_id) \
+            .with_entities(func.count(Bodyweight.id)) \
+            .filter(Bodyweight.date >= datetime.date.today()-datetime.timedelta(days=days)) \
+            .scalar()
+    recent = bodyweight_summary_query(user_id) \
+            .with_entities(Bodyweight.bodyweight) \
+            .order_by(Bodyweight.date.desc()) \
+            .order_by(Bodyweight.time.desc()) \
+            .limit(max(window_count, min_count)) \
+            .subquery()
+    avg_weight = db.session.query(func.avg(recent.c.bodyweight)).scalar()
+    if avg_weight is None:
+        return None
+    return float(avg_weight)*units_scale
+
 class BodyweightSummary(Resource):
     @login_required
     def get(self):
@@ -276,6 +689,15 @@ class BodyweightSummary(Resource):
                 by_time:
                   type: array
                   description: An array containing the mean bodyweight as a function of time of day.
+                hourly_mean:
+                  type: array
+                  description: Mean bodyweight of the entries logged in each hour of the day. `null` for hours with no entries.
+                hourly_std:
+                  type: array
+                  description: Standard deviation of the bodyweight of the entries logged in each hour of the day. `null` for hours with no entries.
+                weight_change_per_day:
+                  type: number
+                  description: Slope of the least-squares line through the entries with a time logged in the week up to the most recent one. `null` if there are fewer than three.
                 history:
                   type: object
                   properties:
@@ -288,78 +710,29 @@ class BodyweightSummary(Resource):
                       items: number
                       description: Evenly-spaced bodyweight where the first data point is on `start_date` and the last is on `end_date`.
         """
-        weights = db.session.query(Bodyweight) \
-                .filter_by(user_id=current_user.get_id()) \
-                .filter(Bodyweight.time.isnot(None)) \
-                .filter(Bodyweight.bodyweight.isnot(None)) \
-                .order_by(Bodyweight.date) \
-                .order_by(Bodyweight.time) \
-                .all()
-        units = db.session.query(UserProfile) \
-                .with_entities(
-                        UserProfile.prefered_units
-                )\
-                .filter_by(id=current_user.get_id()) \
-                .one()[0]
+        # The output also depends on the prefered units and on today's date.
+        # The units are read from the database rather than the cache, so that the ETag always matches the body.
+        user_id = int(current_user.get_id())
+        units = user_cache.get_prefered_units(user_id, cached=False)
+        etag = versions.make_etag('bodyweight', versions.get_version('bodyweight', user_id), user_id,
+                '%s-%s-%s' % (units.name, datetime.date.today(), versions.query_key()))
+        response = versions.not_modified(etag)
+        if response is not None:
+            return response
+
         units_scale = 1
         if units == WeightUnitsEnum.lbs:
             units_scale = 1/0.45359237
 
-        hourly_stats = tracker_data.bodyweight.compute_hourly_stats(
-                db.session, user_id=current_user.get_id())
-        hourly_mean = [w*units_scale for w in hourly_stats[0]]
-        hourly_std = [s*units_scale for s in hourly_stats[1]]
-
-        # Compute history
-        num_buckets = 20
-        start_date = weights[0].date
-        end_date = weights[-1].date
-        bucket_size = (end_date-start_date)/num_buckets
-        weight_buckets = [[] for _ in range(num_buckets)]
-        current_bucket = 0
-        for w in weights:
-            while w.date > start_date+(current_bucket+1)*bucket_size:
-                current_bucket += 1
-            weight_buckets[current_bucket].append(float(w.bodyweight))
-        mean_weights_over_time = [np.mean(x)*units_scale if len(x)>0 else None for x in weight_buckets]
-        history = {
-            'start_date': str(start_date),
-            'end_date': str(end_date),
-            'data': mean_weights_over_time
-        }
+        hourly_stats = bodyweight_stats.get_hourly_stats(user_id)
+        hourly_mean = [w*units_scale if w is not None else None for w in hourly_stats[0]]
+        hourly_std = [s*units_scale if s is not None else None for s in hourly_stats[1]]
 
-        # Compute rate of change
-        points = []
-        rate_of_change = None
-        start_date = weights[-1].date-datetime.timedelta(days=7)
-        for w in weights:
-            if w.date < start_date:
-                continue
-            points.append((
-                (w.date-start_date).total_seconds(),
-                float(w.bodyweight)
-            ))
-        weight_change_per_day = None
-        if len(points) > 2:
-            # Compute line of best fit
-            x = [t for t,w in points]
-            y = [w for t,w in points]
-            slope,_ = np.polyfit(x,y,1)
-            weight_change_per_day = slope*(24*60*60)*units_scale
-
-        # Compute average bodyweight
-        avg_weight = 0
-        count = 0
-        for w in reversed(weights):
-            if datetime.date.today()-w.date > datetime.timedelta(days=7) and count > 5:
-                break
-            avg_weight += float(w.bodyweight)
-            count += 1
-        avg_weight *= units_scale
-        if count == 0:
-            avg_weight = None
-        else:
-            avg_weight /= count
+        history = compute_bodyweight_history(user_id, units_scale)
+        weight_change_per_day = bodyweight_stats.get_weight_change_per_day(user_id)
+        if weight_change_per_day is not None:
+            weight_change_per_day *= units_scale
+        avg_weight = compute_recent_average(user_id, units_scale)
 
         return {
             'summary': {
@@ -370,10 +743,12 @@ class BodyweightSummary(Resource):
                 'units': units.name,
                 'avg_weight': avg_weight
             }
-        }, 200
+        }, 200, versions.etag_headers(etag)
 
 api.add_resource(BodyweightList, '/body/weights')
 api.add_resource(Bodyweights, '/body/weights/<int:entry_id>')
+api.add_resource(BodyweightImport, '/body/weights/import')
 api.add_resource(BodyweightSummary, '/body/weights/summary')
+api.add_resource(BodyweightSeries, '/body/weights/series')
 
 
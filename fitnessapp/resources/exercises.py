@@ -1,6 +1,6 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
@@ -16,10 +16,32 @@ import numpy as np
 
 from tracker_database import Exercise
 from fitnessapp.extensions import db
+from fitnessapp import versions
+from fitnessapp.encoding import Api
 
 blueprint = Blueprint('exercises', __name__)
 api = Api(blueprint)
 
+# How long a worker trusts its copy of the catalog version before checking
+# the database again.
+CATALOG_VERSION_MAX_AGE = 10
+
+# (version, serialized exercises)
+_catalog = None
+
+def get_catalog(version):
+    """ Return the serialized exercise catalog at the given version, loading it from the database only if the version changed. """
+    global _catalog
+    catalog = _catalog
+    if catalog is not None and catalog[0] == version:
+        return catalog[1]
+    entities = db.session.query(Exercise) \
+            .all()
+    data = [e.to_dict() for e in entities]
+    data = dict([(d['id'],d) for d in data])
+    _catalog = (version, data)
+    return data
+
 class ExerciseList(Resource):
     @login_required
     def get(self):
@@ -45,16 +67,16 @@ class ExerciseList(Resource):
               items:
                 $ref: '#/definitions/Exercise'
         """
-        # Get filters from query parameters
-        entities = db.session.query(Exercise) \
-                .all()
-        data = [e.to_dict() for e in entities]
-        data = dict([(d['id'],d) for d in data])
+        version = versions.get_version('exercises', max_age=CATALOG_VERSION_MAX_AGE)
+        etag = versions.make_etag('exercises', version)
+        response = versions.not_modified(etag)
+        if response is not None:
+            return response
         return {
             'entities': {
-                'exercises': data
+                'exercises': get_catalog(version)
             }
-        }, 200
+        }, 200, versions.etag_headers(etag)
 
     @login_required
     def post(self):
@@ -87,6 +109,7 @@ class ExerciseList(Resource):
         exercise = Exercise(**data)
 
         db.session.add(exercise)
+        versions.bump_version('exercises')
         db.session.flush()
         db.session.commit()
 
@@ -135,6 +158,7 @@ class Exercises(Resource):
             }, 404
 
         db.session.delete(entity)
+        versions.bump_version('exercises')
         db.session.flush()
         db.session.commit()
         return {
@@ -189,6 +213,7 @@ class Exercises(Resource):
         for k,v in data.items():
             entity.__setattr__(k,v)
 
+        versions.bump_version('exercises')
         db.session.flush()
         db.session.commit()
 
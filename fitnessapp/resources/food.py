@@ -1,6 +1,6 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
@@ -19,11 +19,13 @@ import os
 import boto3
 
 from fitnessapp import dbutils
+from fitnessapp import food_context
 from fitnessapp.extensions import db
+from fitnessapp import encoding
+from fitnessapp import versions
+from fitnessapp.encoding import Api
 from tracker_database import Food, Photo
 
-import tracker_data
-
 blueprint = Blueprint('food', __name__)
 api = Api(blueprint)
 
@@ -165,6 +167,8 @@ class FoodEndpoint(Resource):
         for p in photos:
             p.food_id = None
         db.session.flush()
+        if len(photos) > 0:
+            versions.bump_version('photos', current_user.get_id())
 
         deleted_ids = dbutils.delete_food(f)
         return {
@@ -197,13 +201,24 @@ class FoodList(Resource):
               items:
                 $ref: '#/definitions/Food'
         """
+        user_id = int(current_user.get_id())
+        etag = versions.make_etag('food', versions.get_version('food', user_id),
+                user_id, versions.query_key())
+        response = versions.not_modified(etag)
+        if response is not None:
+            return response
+
         date = request.args.get('date')
         if date is None:
+            # Full history. Stream it rather than building it all in memory.
             foods = db.session.query(Food) \
                     .filter_by(user_id=current_user.get_id()) \
                     .filter(Food.parent_id.is_(None)) \
                     .order_by(Food.id) \
-                    .all()
+                    .yield_per(500)
+            return encoding.stream_entities('food',
+                    ((f.id, dbutils.food_to_dict(f)) for f in foods),
+                    versions.etag_headers(etag))
         else:
             foods = db.session.query(Food) \
                     .order_by(Food.date.desc()) \
@@ -217,7 +232,7 @@ class FoodList(Resource):
             'entities': {
                 'food': data
             }
-        }, 200
+        }, 200, versions.etag_headers(etag)
 
     @login_required
     def post(self):
@@ -314,6 +329,7 @@ class FoodList(Resource):
         """
         data = request.get_json()
         deleted_ids = []
+        released_photos = []
         for d in data:
             print("Requesting to delete entry %s." % d['id'])
 
@@ -324,12 +340,26 @@ class FoodList(Resource):
                     .first()
             if f is None:
                 continue
+
+            # Check for photos referencing this food item
+            photos = db.session.query(Photo) \
+                    .filter_by(food_id=food_id) \
+                    .filter_by(user_id=current_user.get_id()) \
+                    .all()
+            for p in photos:
+                p.food_id = None
+            db.session.flush()
+            if len(photos) > 0:
+                versions.bump_version('photos', current_user.get_id())
+            released_photos += photos
+
             deleted_ids += dbutils.delete_food(f)
 
         return {
             "message": "Deleted successfully",
             "entities": {
-                "food": dict([(i,None) for i in deleted_ids])
+                "food": dict([(i,None) for i in deleted_ids]),
+                "photos": dict([(p.id, dbutils.photo_to_dict(p)) for p in released_photos])
             }
         }, 200
 
@@ -391,6 +421,14 @@ class FoodSummary(Resource):
                   type: array
                   description: A list of total calories consumed in the last week. The number at index 0 is today's Calorie consumption, 1 is yesterday, etc.
         """
+        # The summary covers the last week, so it changes with the date as well as with the entries.
+        user_id = int(current_user.get_id())
+        etag = versions.make_etag('food', versions.get_version('food', user_id),
+                user_id, '%s-%s' % (datetime.date.today(), versions.query_key()))
+        response = versions.not_modified(etag)
+        if response is not None:
+            return response
+
         start_date = datetime.date.today()-datetime.timedelta(days=7)
         foods = db.engine.execute("""
             SELECT date, SUM(calories)
@@ -437,7 +475,7 @@ class FoodSummary(Resource):
                 'history': [to_dict(f) for f in foods],
                 'calorie_change_per_day': calorie_change_per_day
             }
-        }, 200
+        }, 200, versions.etag_headers(etag)
 
 class FoodAutogenerate(Resource):
     @login_required
@@ -445,8 +483,13 @@ class FoodAutogenerate(Resource):
         if 'date' not in request.args:
             return 'Invalid request. A date is required.', 400
         date = request.args['date']
-        dbutils.autogenerate_food_entry_for_date(date)
-        return 'Autogenerated entries successfully', 200
+        foods = dbutils.autogenerate_food_entry_for_date(date, current_user.get_id())
+        return {
+            'message': 'Autogenerated entries successfully',
+            'entities': {
+                'food': dict([(f.id, dbutils.food_to_dict(f)) for f in foods])
+            }
+        }, 200
 
 class FoodPredict(Resource):
     @login_required
@@ -459,11 +502,10 @@ class FoodPredict(Resource):
             siblings = []
         else:
             siblings = request.args['siblings'].split(',')
-        predictions = tracker_data.predict_from_context(
-                db_session=db.session,
+        predictions = food_context.predict(
                 user_id=current_user.get_id(),
                 parent_name=parent,
-                sibling_entries=siblings
+                sibling_names=siblings
         )
         print(predictions)
         return {
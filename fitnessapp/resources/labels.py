@@ -1,8 +1,9 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 from sqlalchemy.sql import func
 from werkzeug.utils import secure_filename
 from flasgger import SwaggerView
@@ -12,12 +13,39 @@ import os
 from PIL import Image
 import base64
 from io import BytesIO
+import numpy as np
 
 import tracker_database as database
+from fitnessapp.extensions import db
+from fitnessapp.encoding import Api
 
 blueprint = Blueprint('labels', __name__)
 api = Api(blueprint)
 
+def parse_id_list(value):
+    """ Parse a comma-separated list of IDs from a query parameter. """
+    if value is None:
+        return None
+    return [int(x) for x in value.split(',') if x != '']
+
+def label_bounds(label):
+    """ Return the (x0, y0, x1, y1) bounds of a serialized label, taken from its bounding box or, if it has none, from its bounding polygon. """
+    points = label.get('bounding_box') or label.get('bounding_polygon')
+    if not points:
+        return None
+    points = np.array(points, dtype=float)
+    return (*points.min(axis=0), *points.max(axis=0))
+
+def filter_overlapping(labels, bbox):
+    """ Keep the serialized labels whose bounds overlap the box (x0, y0, x1, y1). """
+    bounds = [label_bounds(l) for l in labels]
+    labels = [l for l,b in zip(labels,bounds) if b is not None]
+    bounds = np.array([b for b in bounds if b is not None], dtype=float).reshape(-1,4)
+    x0, y0, x1, y1 = bbox
+    overlap = (bounds[:,0] <= max(x0,x1)) & (bounds[:,2] >= min(x0,x1)) & \
+              (bounds[:,1] <= max(y0,y1)) & (bounds[:,3] >= min(y0,y1))
+    return [l for l,o in zip(labels,overlap) if o]
+
 class Labels(Resource):
     @login_required
     def get(self, label_id):
@@ -57,10 +85,26 @@ class Labels(Resource):
           200:
             schema:
               $ref: '#/definitions/Label'
+          404:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
         """
+        label = db.session.query(database.PhotoLabel) \
+                .filter_by(id=label_id) \
+                .filter_by(user_id=current_user.get_id()) \
+                .first()
+        if label is None:
+            return {
+                'error': 'Unable to find label with ID %d.' % label_id
+            }, 404
         return {
-                'error': 'Not implemented'
-        }, 501
+            'entities': {
+                'labels': {label.id: label.to_dict()}
+            }
+        }, 200
 
     @login_required
     def put(self, label_id):
@@ -90,22 +134,39 @@ class Labels(Resource):
               properties:
                 error:
                   type: string
+          404:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
         """
         data = request.get_json()
 
         # Check that this label exists and is owned by the current user
-        label = database.PhotoLabel.query \
+        label = db.session.query(database.PhotoLabel) \
                 .filter_by(id=label_id) \
-                .filter_by(user_id=current_user.get_id()) \
-                .one()
+                .filter_by(user_id=int(current_user.get_id())) \
+                .first()
+        if label is None:
+            return {
+                'error': 'Unable to find label with ID %d.' % label_id
+            }, 404
 
-        # Create new label to replace current one
-        label = database.PhotoLabel.from_dict(data)
-        label.id = label_id
+        # Copy the new values onto the existing label. Its ID, owner and photo cannot be changed.
+        new_label = database.PhotoLabel.from_dict(data)
+        for attr in inspect(database.PhotoLabel).column_attrs:
+            if attr.key in ('id', 'user_id', 'photo_id'):
+                continue
+            setattr(label, attr.key, getattr(new_label, attr.key))
+        try:
+            label.validate()
+        except Exception as e:
+            db.session.rollback()
+            return {'error': str(e)}, 400
 
-        database.db_session.add(label)
-        database.db_session.flush()
-        database.db_session.commit()
+        db.session.flush()
+        db.session.commit()
 
         return {'message': 'Success?', 'id': label.id}, 200
 
@@ -134,28 +195,36 @@ class Labels(Resource):
                 error:
                   type: string
         """
-        label = database.PhotoLabel.query \
+        label = db.session.query(database.PhotoLabel) \
                 .filter_by(id=label_id) \
                 .filter_by(user_id=current_user.get_id()) \
                 .one()
-        database.db_session.delete(label)
-        database.db_session.flush()
-        database.db_session.commit()
+        db.session.delete(label)
+        db.session.flush()
+        db.session.commit()
 
         return {'message': 'Success?', 'id': label.id}, 200
 
 class LabelList(Resource):
     @login_required
     def get(self):
-        """ Return some labels?
+        """ Return all labels matching the given criteria.
         ---
         tags:
           - labels
         parameters:
           - name: photo_id
             in: query
-            type: number
-            description: Not yet implemented. This does nothing for now.
+            type: string
+            description: Comma-separated list of photo IDs.
+          - name: tag_id
+            in: query
+            type: string
+            description: Comma-separated list of tag IDs.
+          - name: bbox
+            in: query
+            type: string
+            description: Only return labels whose bounds overlap this box, given as `x0,y0,x1,y1`.
         responses:
           200:
             description: A list of labels
@@ -163,10 +232,38 @@ class LabelList(Resource):
               type: array
               items:
                 $ref: '#/definitions/Label'
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
         """
+        try:
+            photo_ids = parse_id_list(request.args.get('photo_id'))
+            tag_ids = parse_id_list(request.args.get('tag_id'))
+            bbox = request.args.get('bbox')
+            if bbox is not None:
+                bbox = [float(x) for x in bbox.split(',')]
+                if len(bbox) != 4:
+                    raise ValueError('Expected four bounding box coordinates.')
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+        query = db.session.query(database.PhotoLabel) \
+                .filter_by(user_id=current_user.get_id())
+        if photo_ids is not None:
+            query = query.filter(database.PhotoLabel.photo_id.in_(photo_ids))
+        if tag_ids is not None:
+            query = query.filter(database.PhotoLabel.tag_id.in_(tag_ids))
+        labels = [l.to_dict() for l in query.all()]
+        if bbox is not None:
+            labels = filter_overlapping(labels, bbox)
         return {
-                'error': 'Not implemented'
-        }, 501
+            'entities': {
+                'labels': dict([(l['id'], l) for l in labels])
+            }
+        }, 200
 
     @login_required
     def post(self):
@@ -209,17 +306,133 @@ class LabelList(Resource):
         data = request.get_json()
 
         label = database.PhotoLabel.from_dict(data)
-        label.user_id = current_user.get_id()
+        label.user_id = int(current_user.get_id())
         try:
             label.validate()
         except Exception as e:
             return {'error': str(e)}, 400
 
-        database.db_session.add(label)
-        database.db_session.flush()
-        database.db_session.commit()
+        db.session.add(label)
+        db.session.flush()
+        db.session.commit()
 
         return {'id': label.id}, 200
 
+class PhotoLabels(Resource):
+    def save_labels(self, photo_id, replace):
+        data = request.get_json()
+        if not isinstance(data, list):
+            return {'error': 'Expected a list of labels.'}, 400
+
+        user_id = int(current_user.get_id())
+        photo = db.session.query(database.Photo) \
+                .filter_by(id=photo_id) \
+                .filter_by(user_id=user_id) \
+                .first()
+        if photo is None:
+            return {'error': 'Unable to find photo with ID %d.' % photo_id}, 404
+
+        labels = []
+        for d in data:
+            label = database.PhotoLabel.from_dict(d)
+            label.id = None
+            label.user_id = user_id
+            label.photo_id = photo_id
+            try:
+                label.validate()
+            except Exception as e:
+                return {'error': str(e)}, 400
+            labels.append(label)
+
+        deleted_ids = []
+        if replace:
+            existing = db.session.query(database.PhotoLabel) \
+                    .filter_by(photo_id=photo_id) \
+                    .filter_by(user_id=user_id) \
+                    .all()
+            for label in existing:
+                deleted_ids.append(label.id)
+                db.session.delete(label)
+        db.session.add_all(labels)
+        db.session.flush()
+        db.session.commit()
+
+        entities = dict([(i, None) for i in deleted_ids])
+        entities.update([(l.id, l.to_dict()) for l in labels])
+        return {
+            'message': 'Labels saved successfully.',
+            'entities': {
+                'labels': entities
+            }
+        }, 200
+
+    @login_required
+    def post(self, photo_id):
+        """ Add many labels to a photo at once.
+        ---
+        tags:
+          - labels
+        parameters:
+          - name: photo_id
+            in: path
+            type: integer
+            required: true
+          - in: body
+            required: true
+            schema:
+              type: array
+              items:
+                $ref: '#/definitions/Label'
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        return self.save_labels(photo_id, replace=False)
+
+    @login_required
+    def put(self, photo_id):
+        """ Replace all of a photo's labels in one transaction.
+        ---
+        tags:
+          - labels
+        parameters:
+          - name: photo_id
+            in: path
+            type: integer
+            required: true
+          - in: body
+            required: true
+            schema:
+              type: array
+              items:
+                $ref: '#/definitions/Label'
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        return self.save_labels(photo_id, replace=True)
+
 api.add_resource(LabelList, '/labels')
+api.add_resource(Labels, '/labels/<int:label_id>')
+api.add_resource(PhotoLabels, '/photos/<int:photo_id>/labels')
 
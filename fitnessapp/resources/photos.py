@@ -1,6 +1,6 @@
 from flask import Blueprint, Response, send_file
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
@@ -10,9 +10,12 @@ from flasgger import SwaggerView
 
 import datetime
 
-from fitnessapp import dbutils
+from fitnessapp import dbutils, tracing
 from tracker_database import Photo, Food
 from fitnessapp.extensions import db
+from fitnessapp import encoding
+from fitnessapp import versions
+from fitnessapp.encoding import Api
 
 blueprint = Blueprint('photos', __name__)
 api = Api(blueprint)
@@ -93,6 +96,8 @@ class Photos(Resource):
             photo.food_id = data['food_id']
 
         db.session.flush()
+        versions.bump_version('photos', photo.user_id)
+        versions.bump_version('food', photo.user_id)
         db.session.commit()
 
         return {'message': 'Updated successfully'}, 200
@@ -167,6 +172,13 @@ class PhotoList(Resource):
               items:
                 $ref: '#/definitions/Photo'
         """
+        user_id = int(current_user.get_id())
+        etag = versions.make_etag('photos', versions.get_version('photos', user_id),
+                user_id, versions.query_key())
+        response = versions.not_modified(etag)
+        if response is not None:
+            return response
+
         # Get filters from query parameters
         filterable_params = ['id', 'user_id', 'date']
         filter_params = {}
@@ -178,12 +190,10 @@ class PhotoList(Resource):
         photos = db.session.query(Photo) \
                 .filter_by(user_id=current_user.get_id()) \
                 .filter_by(**filter_params) \
-                .all()
-        return {
-            'entities': {
-                'photos': dict([(p.id,dbutils.photo_to_dict(p)) for p in photos])
-            }
-        }, 200
+                .yield_per(500)
+        return encoding.stream_entities('photos',
+                ((p.id, dbutils.photo_to_dict(p)) for p in photos),
+                versions.etag_headers(etag))
 
     @login_required
     def post(self):
@@ -224,7 +234,7 @@ class PhotoList(Resource):
             # Create food entry
             photo = Photo()
             photo.file_name = ""
-            photo.user_id = current_user.get_id()
+            photo.user_id = int(current_user.get_id())
             photo.upload_time = datetime.datetime.utcnow()
             photo.date = request.form.get('date')
             photo.time = request.form.get('time')
@@ -249,7 +259,11 @@ class PhotoList(Resource):
                     photo.date = exif_data[0x9003].split(' ')[0].replace(':','-')
             # Save file name
             db.session.flush()
-            db.session.commit()
+            versions.bump_version('photos', photo.user_id)
+            if photo.food_id is not None:
+                versions.bump_version('food', photo.user_id)
+            with tracing.span('db.commit'):
+                db.session.commit()
 
             return {
                 'message': 'Photo uploaded successfully.',
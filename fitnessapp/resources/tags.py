@@ -1,6 +1,6 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
@@ -14,6 +14,10 @@ import base64
 from io import BytesIO
 
 import tracker_database as database
+from fitnessapp.extensions import db
+from fitnessapp import tag_tree
+from fitnessapp import versions
+from fitnessapp.encoding import Api
 
 blueprint = Blueprint('tags', __name__)
 api = Api(blueprint)
@@ -42,11 +46,6 @@ class TagList(Resource):
               description:
                 type: string
                 description: A description of what this tag represents.
-        parameters:
-          - name: user_id 
-            in: query
-            type: number
-            description: Not yet implemented. This does nothing for now.
         responses:
           200:
             description: A list of tags
@@ -55,10 +54,7 @@ class TagList(Resource):
               items:
                 $ref: '#/definitions/Tag'
         """
-        user_id = current_user.get_id()
-        # TODO: Filter by user
-        tags = database.Tag.query.all()
-        tags = dict([(t.id, t.to_dict()) for t in tags])
+        tags = tag_tree.get_tags(current_user.get_id())
         return {
             'entities': {
                 'tags': tags
@@ -98,15 +94,20 @@ class TagList(Resource):
         data = request.get_json()
 
         tag = database.Tag.from_dict(data)
-        tag.user_id = current_user.get_id()
+        tag.user_id = int(current_user.get_id())
         try:
             tag.validate()
         except Exception as e:
             return {'error': str(e)}, 400
+        if tag.parent_id is not None and not tag_tree.tag_exists(tag.user_id, tag.parent_id):
+            return {'error': 'Parent tag %s not found.' % tag.parent_id}, 400
 
-        database.db_session.add(tag)
-        database.db_session.flush()
-        database.db_session.commit()
+        db.session.add(tag)
+        db.session.flush()
+        tag_tree.add_to_closure(tag)
+        versions.bump_version('tags', tag.user_id)
+        db.session.commit()
+        tag_tree.invalidate(tag.user_id)
 
         return {
                 'message': 'Success?',
@@ -138,13 +139,47 @@ class TagSearch(Resource):
         if 'q' not in request.args:
             return 'Invalid request. A query is required.', 400
         query = request.args['q']
-        tags = database.Tag.query \
-                .filter_by(user_id=current_user.get_id()) \
-                .filter(database.Tag.tag.ilike('%{0}%'.format(query))) \
-                .limit(5) \
-                .all()
-        data = [t.to_dict() for t in tags]
-        return data, 200
+        return tag_tree.search_tags(current_user.get_id(), query), 200
+
+class TagDescendants(Resource):
+    @login_required
+    def get(self, tag_id):
+        """ Return a tag along with all of its descendants.
+        ---
+        tags:
+          - tags
+        parameters:
+          - name: tag_id
+            in: path
+            type: integer
+            required: true
+        responses:
+          200:
+            description: A list of tags
+            schema:
+              type: array
+              items:
+                $ref: '#/definitions/Tag'
+          404:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        user_id = int(current_user.get_id())
+        if not tag_tree.tag_exists(user_id, tag_id):
+            return {
+                'error': 'Unable to find tag with ID %d.' % tag_id
+            }, 404
+        tags = tag_tree.get_tags(user_id)
+        descendant_ids = tag_tree.get_descendant_ids(tag_id)
+        return {
+            'entities': {
+                'tags': dict([(i, tags[i]) for i in descendant_ids if i in tags])
+            }
+        }, 200
 
 api.add_resource(TagList, '/tags')
 api.add_resource(TagSearch, '/tags/search')
+api.add_resource(TagDescendants, '/tags/<int:tag_id>/descendants')
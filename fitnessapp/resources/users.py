@@ -1,6 +1,6 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 import flask_login
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
@@ -13,14 +13,25 @@ import os
 from PIL import Image
 import base64
 from io import BytesIO
-import bcrypt
-
 from tracker_database import User, UserProfile, WeightUnitsEnum
 from fitnessapp.extensions import db
+from fitnessapp import user_cache, passwords, tokens, versions
+from fitnessapp.encoding import Api
 
 blueprint = Blueprint('users', __name__)
 api = Api(blueprint)
 
+PUBLIC_PROFILE_FIELDS = ['id', 'display_name', 'last_activity']
+MAX_PROFILES_PER_REQUEST = 100
+
+def visible_profile(profile):
+    """ Return the fields of a cached profile (see `user_cache.profile_to_dict`) that the current user is allowed to see. Users see all of their own profile, and only the public fields of everyone else's. """
+    if profile['id'] == int(current_user.get_id()):
+        result = dict(profile)
+        result['prefered_units'] = profile['prefered_units'].name
+        return result
+    return {k: profile[k] for k in PUBLIC_PROFILE_FIELDS}
+
 class UserList(Resource):
     def post(self):
         """ Create a new user
@@ -53,17 +64,27 @@ class UserList(Resource):
               properties:
                 error:
                   type: string
+          429:
+            description: Too many attempts from this address
+          503:
+            description: Too many password operations in progress
         """
         data = request.get_json()
 
         user = User()
         user.email = data['email']
-        user.password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt(12))
 
         existing_user = db.session.query(User)\
                 .filter_by(email=user.email) \
                 .all()
         if len(existing_user) == 0:
+            try:
+                passwords.check_rate_limit(request.remote_addr)
+                user.password = passwords.hash_password(data['password'])
+            except passwords.TooManyAttempts as e:
+                return {'error': str(e)}, 429
+            except passwords.PasswordHashBusy as e:
+                return {'error': str(e)}, 503
             db.session.add(user)
             db.session.flush()
             db.session.commit()
@@ -128,42 +149,17 @@ class UserProfiles(Resource):
               $ref: '#/definitions/UserProfile'
         """
         user_id = int(user_id)
-        user = db.session.query(UserProfile) \
-                .filter_by(id=user_id) \
-                .first()
+        profile = user_cache.get_profile(user_id)
 
-        if user is None:
+        if profile is None:
             return {
                 'error': 'No user matching ID '+str(user_id)
             }, 400
 
-        if user_id == current_user.get_id():
-            result = {
-                'id': user.id,
-                'display_name': user.display_name,
-                'gender': user.gender,
-                'last_activity': user.last_activity,
-
-                'prefered_units': user.prefered_units.name,
-
-                'target_weight': user.target_weight,
-                'target_calories': user.target_calories,
-                'weight_goal': user.weight_goal,
-
-                'country': user.country,
-                'state': user.state,
-                'city': user.city
-            }
-        else:
-            result = {
-                'id': user.id,
-                'display_name': user.display_name,
-                'last_activity': user.last_activity
-            }
         return {
             'entities': {
                 'userProfiles': {
-                    user.id: result
+                    user_id: visible_profile(profile)
                 }
             }
         }, 200
@@ -201,7 +197,7 @@ class UserProfiles(Resource):
         data = request.get_json()
 
         # Make sure the user is modifying their own account
-        if user_id != current_user.get_id():
+        if user_id != int(current_user.get_id()):
             return {
                 'error': 'You do not have permission to modify this account'
             }, 400
@@ -224,7 +220,9 @@ class UserProfiles(Resource):
                 'error': str(e)
             }, 400
 
+        versions.bump_version('profile', user_id)
         db.session.commit()
+        user_cache.invalidate_user(user_id)
 
         return {
                 'message': 'success',
@@ -235,6 +233,61 @@ class UserProfiles(Resource):
                 }
         }, 200
 
+class UserProfileList(Resource):
+    @login_required
+    def get(self):
+        """ Return the profiles of several users.
+        IDs with no matching user are left out of the response.
+        ---
+        tags:
+          - user profiles
+        parameters:
+          - name: ids
+            in: query
+            type: string
+            required: true
+            description: Comma-separated list of user IDs
+        responses:
+          200:
+            description: User profiles
+            schema:
+              type: object
+              properties:
+                entities:
+                  type: object
+                  properties:
+                    userProfiles:
+                      type: object
+                      additionalProperties:
+                        $ref: '#/definitions/UserProfile'
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        try:
+            user_ids = [int(x) for x in request.args.get('ids', '').split(',') if x != '']
+        except ValueError:
+            return {
+                'error': 'Invalid user IDs'
+            }, 400
+        if len(user_ids) > MAX_PROFILES_PER_REQUEST:
+            return {
+                'error': 'Too many user IDs. At most %d can be requested at once.' % MAX_PROFILES_PER_REQUEST
+            }, 400
+
+        profiles = user_cache.get_profiles(user_ids)
+        return {
+            'entities': {
+                'userProfiles': {
+                    user_id: visible_profile(profile)
+                    for user_id, profile in profiles.items()
+                }
+            }
+        }, 200, {'Cache-Control': 'private, max-age=60'}
+
 class UserPassword(Resource):
     def post(self):
         """ Change Password
@@ -264,25 +317,37 @@ class UserPassword(Resource):
               properties:
                 error:
                   type: string
+          429:
+            description: Too many attempts from this address
+          503:
+            description: Too many password operations in progress
         """
         data = request.get_json()
 
         user = db.session.query(User)\
                 .filter_by(id=current_user.get_id()) \
                 .one()
-        if not bcrypt.checkpw(data['password'].encode('utf-8'), user.password.tobytes()):
-            return {
-                    'error': 'Incorrect password'
-            }, 403
-
-        user.password = bcrypt.hashpw(data['new_password'].encode('utf-8'), bcrypt.gensalt(12))
+        try:
+            passwords.check_rate_limit(request.remote_addr)
+            if not passwords.check_password(data['password'], user.password.tobytes()):
+                return {
+                        'error': 'Incorrect password'
+                }, 403
+            user.password = passwords.hash_password(data['new_password'])
+        except passwords.TooManyAttempts as e:
+            return {'error': str(e)}, 429
+        except passwords.PasswordHashBusy as e:
+            return {'error': str(e)}, 503
+        tokens.revoke_all(user.id)
 
         db.session.flush()
         db.session.commit()
+        user_cache.invalidate_user(user.id)
         return {
             'message': "Password updated successfully."
         }, 200
 
 api.add_resource(UserList, '/users')
+api.add_resource(UserProfileList, '/user_profiles')
 api.add_resource(UserProfiles, '/user_profiles/<int:user_id>')
 api.add_resource(UserPassword, '/users/change_password')
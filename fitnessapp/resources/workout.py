@@ -1,13 +1,15 @@
 from flask import Blueprint
 from flask import request
-from flask_restful import Api, Resource
+from flask_restful import Resource
 from flask_login import login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
+import sqlalchemy
 from werkzeug.utils import secure_filename
 from flasgger import SwaggerView
 
 import datetime
+import json
 import os
 from PIL import Image
 import base64
@@ -16,6 +18,10 @@ import numpy as np
 
 from tracker_database import WorkoutSet, Exercise
 from fitnessapp.extensions import db
+from fitnessapp import workout_rollups
+from fitnessapp import encoding
+from fitnessapp.encoding import Api
+import fitnessapp.models # Registers the (user_id, date, order) index on WorkoutSet
 
 blueprint = Blueprint('workoutset', __name__)
 api = Api(blueprint)
@@ -81,20 +87,15 @@ class WorkoutSetList(Resource):
                 filter_params[p] = val
         worksets = db.session.query(WorkoutSet) \
                 .filter_by(user_id=current_user.get_id()) \
+                .filter_by(**filter_params) \
                 .order_by(WorkoutSet.date.desc()) \
                 .order_by(WorkoutSet.order.desc()) \
-                .all()
-        data = [{
+                .yield_per(1000)
+        return encoding.stream_entities('workout_sets', ((s.id, {
             'id': s.id,
             'date': str(s.date),
             'reps': s.reps,
-        } for s in worksets]
-        data = dict([(d['id'],d) for d in data])
-        return {
-            'entities': {
-                'workout_sets': data
-            }
-        }, 200
+        }) for s in worksets))
 
     @login_required
     def post(self):
@@ -125,10 +126,11 @@ class WorkoutSetList(Resource):
         data = request.get_json()
 
         workset = WorkoutSet(**data)
-        workset.user_id = current_user.get_id()
+        workset.user_id = int(current_user.get_id())
 
         db.session.add(workset)
         db.session.flush()
+        workout_rollups.refresh_rollups(workset.user_id, [(workset.exercise_id, workset.date)])
         db.session.commit()
 
         return {
@@ -176,8 +178,10 @@ class WorkoutSets(Resource):
                 'error': "Unable to find requested entity."
             }, 404
 
+        rollup_keys = [(entity.exercise_id, entity.date)]
         db.session.delete(entity)
         db.session.flush()
+        workout_rollups.refresh_rollups(entity.user_id, rollup_keys)
         db.session.commit()
         return {
             'message': "Deleted successfully",
@@ -229,10 +233,13 @@ class WorkoutSets(Resource):
                 'error': "Unable to find requested entity."
             }, 404
 
+        rollup_keys = [(entity.exercise_id, entity.date)]
         for k,v in data.items():
             entity.__setattr__(k,v)
 
         db.session.flush()
+        rollup_keys.append((entity.exercise_id, entity.date))
+        workout_rollups.refresh_rollups(entity.user_id, rollup_keys)
         db.session.commit()
 
         return {
@@ -244,5 +251,389 @@ class WorkoutSets(Resource):
             }
         }, 200
 
+class WorkoutSessionList(Resource):
+    @login_required
+    def get(self):
+        """ Return a summary of the user's workout sessions over a date range.
+        Sets are grouped into sessions by date and `parent_id`, with each parent set in the same session as its children. Sets without a parent that have no children form one session per date.
+        ---
+        tags:
+          - workout
+        parameters:
+          - name: start_date
+            in: query
+            type: string
+            format: date
+          - name: end_date
+            in: query
+            type: string
+            format: date
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                sessions:
+                  type: array
+                  items:
+                    type: object
+                    properties:
+                      date:
+                        type: string
+                      parent_id:
+                        type: number
+                      sets:
+                        type: number
+                      reps:
+                        type: number
+                      duration:
+                        type: number
+                      exercises:
+                        type: array
+                        description: Totals for each exercise in the session, in the order they were first performed.
+                        items:
+                          type: object
+                          properties:
+                            exercise_id:
+                              type: number
+                            sets:
+                              type: number
+                            reps:
+                              type: number
+                            duration:
+                              type: number
+        """
+        user_id = int(current_user.get_id())
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        try:
+            if start_date is not None:
+                start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+            if end_date is not None:
+                end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError as e:
+            return {
+                'error': 'Invalid date: %s' % e
+            }, 400
+
+        def filter_dates(query):
+            if start_date is not None:
+                query = query.filter(WorkoutSet.date >= start_date)
+            if end_date is not None:
+                query = query.filter(WorkoutSet.date <= end_date)
+            return query
+
+        # A set that other sets are grouped under belongs to its own session,
+        # rather than to the date's session of sets without a parent.
+        parents = filter_dates(db.session.query(WorkoutSet)) \
+                .with_entities(WorkoutSet.parent_id) \
+                .filter_by(user_id=user_id) \
+                .filter(WorkoutSet.parent_id.isnot(None)) \
+                .distinct() \
+                .subquery()
+        session_id = func.coalesce(WorkoutSet.parent_id, parents.c.parent_id)
+
+        first_order = func.min(WorkoutSet.order)
+        query = filter_dates(db.session.query(WorkoutSet)) \
+                .with_entities(
+                        WorkoutSet.date,
+                        session_id,
+                        WorkoutSet.exercise_id,
+                        func.count(WorkoutSet.id),
+                        func.sum(WorkoutSet.reps),
+                        func.sum(WorkoutSet.duration),
+                        first_order
+                ) \
+                .outerjoin(parents, parents.c.parent_id == WorkoutSet.id) \
+                .filter(WorkoutSet.user_id == user_id)
+        rows = query \
+                .group_by(
+                        WorkoutSet.date,
+                        session_id,
+                        WorkoutSet.exercise_id
+                ) \
+                .order_by(WorkoutSet.date.desc()) \
+                .order_by(first_order) \
+                .all()
+
+        sessions = []
+        sessions_by_key = {}
+        for date,parent_id,exercise_id,sets,reps,duration,_ in rows:
+            key = (date,parent_id)
+            if key not in sessions_by_key:
+                sessions_by_key[key] = {
+                    'date': str(date),
+                    'parent_id': parent_id,
+                    'sets': 0,
+                    'reps': 0,
+                    'duration': 0,
+                    'exercises': []
+                }
+                sessions.append(sessions_by_key[key])
+            session = sessions_by_key[key]
+            reps = int(reps) if reps is not None else 0
+            duration = float(duration) if duration is not None else 0
+            session['sets'] += sets
+            session['reps'] += reps
+            session['duration'] += duration
+            session['exercises'].append({
+                'exercise_id': exercise_id,
+                'sets': sets,
+                'reps': reps,
+                'duration': duration
+            })
+        return {
+            'sessions': sessions
+        }, 200
+
+    @login_required
+    def post(self):
+        """ Log a whole workout session at once.
+        All sets are created in a single transaction. If `parent` is provided, it is created first and the other sets are grouped under it.
+        ---
+        tags:
+          - workout
+        parameters:
+          - in: body
+            name: body
+            required: true
+            schema:
+              type: object
+              properties:
+                date:
+                  type: string
+                  example: '2019-01-01'
+                parent_id:
+                  type: number
+                  description: ID of an existing set to group the new sets under.
+                parent:
+                  $ref: '#/definitions/WorkoutSet'
+                sets:
+                  type: array
+                  description: Sets in the order they were performed.
+                  items:
+                    $ref: '#/definitions/WorkoutSet'
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        data = request.get_json()
+        user_id = int(current_user.get_id())
+
+        if data is None or data.get('date') is None:
+            return {
+                'error': 'No date provided.'
+            }, 400
+        sets = data.get('sets')
+        if not isinstance(sets, list) or len(sets) == 0:
+            return {
+                'error': 'No sets provided.'
+            }, 400
+        parent = data.get('parent')
+        parent_id = data.get('parent_id')
+        if parent is not None and parent_id is not None:
+            return {
+                'error': 'Only one of parent and parent_id can be provided.'
+            }, 400
+
+        # Check that only known fields are provided
+        allowed_fields = set([c.key for c in WorkoutSet.__table__.c]) - set(['id', 'user_id', 'date', 'parent_id'])
+        for s in sets+([parent] if parent is not None else []):
+            if not isinstance(s, dict):
+                return {
+                    'error': 'Sets must be objects.'
+                }, 400
+            unknown_fields = set(s.keys()) - allowed_fields
+            if len(unknown_fields) > 0:
+                return {
+                    'error': 'Unknown fields: %s' % ', '.join(sorted(unknown_fields))
+                }, 400
+
+        def is_id(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+        if parent_id is not None and not is_id(parent_id):
+            return {
+                'error': 'Invalid parent_id: %s' % json.dumps(parent_id)
+            }, 400
+        for s in sets+([parent] if parent is not None else []):
+            if s.get('exercise_id') is not None and not is_id(s['exercise_id']):
+                return {
+                    'error': 'Invalid exercise_id: %s' % json.dumps(s['exercise_id'])
+                }, 400
+
+        # Validate all exercise IDs in one query
+        exercise_ids = set([
+            s['exercise_id'] for s in sets+([parent] if parent is not None else [])
+            if s.get('exercise_id') is not None
+        ])
+        if len(exercise_ids) > 0:
+            found_ids = db.session.query(Exercise) \
+                    .with_entities(Exercise.id) \
+                    .filter(Exercise.id.in_(list(exercise_ids))) \
+                    .all()
+            missing_ids = exercise_ids - set([x[0] for x in found_ids])
+            if len(missing_ids) > 0:
+                return {
+                    'error': 'Unknown exercise IDs: %s' % ', '.join([str(x) for x in sorted(missing_ids)])
+                }, 400
+
+        if parent_id is not None:
+            existing_parent = db.session.query(WorkoutSet) \
+                    .with_entities(WorkoutSet.id) \
+                    .filter_by(user_id=user_id) \
+                    .filter_by(id=parent_id) \
+                    .first()
+            if existing_parent is None:
+                return {
+                    'error': 'Unable to find parent set %s.' % parent_id
+                }, 400
+
+        # New sets are placed after the sets already logged on that date
+        next_order = db.session.query(WorkoutSet) \
+                .with_entities(func.max(WorkoutSet.order)) \
+                .filter_by(user_id=user_id) \
+                .filter_by(date=data['date']) \
+                .scalar()
+        next_order = 0 if next_order is None else next_order+1
+
+        def make_row(s, parent_id):
+            nonlocal next_order
+            row = dict(s)
+            row['user_id'] = user_id
+            row['date'] = data['date']
+            row['parent_id'] = parent_id
+            if row.get('order') is None:
+                row['order'] = next_order
+                next_order += 1
+            return row
+
+        table = WorkoutSet.__table__
+        created = []
+        try:
+            if parent is not None:
+                result = db.session.execute(
+                    table.insert() \
+                        .values([make_row(parent, None)]) \
+                        .returning(*table.c)
+                )
+                created += result.fetchall()
+                parent_id = created[0]['id']
+            rows = [make_row(s, parent_id) for s in sets]
+            # A multi-row INSERT needs the same columns in every row
+            columns = set().union(*[r.keys() for r in rows])
+            rows = [dict([(c, r.get(c)) for c in columns]) for r in rows]
+            result = db.session.execute(
+                table.insert() \
+                    .values(rows) \
+                    .returning(*table.c)
+            )
+            created += result.fetchall()
+            workout_rollups.refresh_rollups(user_id, [(row['exercise_id'], row['date']) for row in created])
+            db.session.commit()
+        except (sqlalchemy.exc.DataError, sqlalchemy.exc.IntegrityError) as e:
+            db.session.rollback()
+            return {
+                'error': str(e.orig)
+            }, 400
+
+        return {
+            'message': 'Workout sets added successfully.',
+            'entities': {
+                'workout_set': dict([(row['id'], workout_set_row_to_dict(row)) for row in created])
+            }
+        }, 200
+
+def workout_set_row_to_dict(row):
+    output = {}
+    for k,v in row.items():
+        if isinstance(v, (datetime.date, datetime.time)):
+            v = str(v)
+        output[k] = v
+    return output
+
+class ExerciseProgression(Resource):
+    @login_required
+    def get(self, exercise_id):
+        """ Return the user's daily progression on an exercise.
+        ---
+        tags:
+          - workout
+        parameters:
+          - name: exercise_id
+            in: path
+            type: integer
+            required: true
+          - name: start_date
+            in: query
+            type: string
+            format: date
+          - name: end_date
+            in: query
+            type: string
+            format: date
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                progression:
+                  type: array
+                  items:
+                    type: object
+                    properties:
+                      date:
+                        type: string
+                      sets:
+                        type: number
+                      reps:
+                        type: number
+                        description: Total number of repetitions over all sets.
+                      duration:
+                        type: number
+                        description: Total duration over all sets, in seconds.
+                      best_reps:
+                        type: number
+                        description: Most repetitions performed in a single set.
+                      best_duration:
+                        type: number
+                        description: Longest single set, in seconds.
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        try:
+            if start_date is not None:
+                start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+            if end_date is not None:
+                end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError as e:
+            return {
+                'error': 'Invalid date: %s' % e
+            }, 400
+        rollups = workout_rollups.get_rollups(
+                int(current_user.get_id()), exercise_id,
+                start_date=start_date,
+                end_date=end_date)
+        return {
+            'progression': [r.to_dict() for r in rollups]
+        }, 200
+
 api.add_resource(WorkoutSetList, '/workout/sets')
 api.add_resource(WorkoutSets, '/workout/sets/<int:entity_id>')
+api.add_resource(WorkoutSessionList, '/workout/sessions')
+api.add_resource(ExerciseProgression, '/workout/exercises/<int:exercise_id>/progression')
@@ -0,0 +1,105 @@
+""" Per-user tag trees.
+
+The `parent_id` hierarchy is stored in a closure table so that all
+descendants of a tag can be fetched with one index range scan. Each user's
+tags are also cached in memory, keyed on the user's 'tags' version.
+`TagList.post` adds the new tag to the closure table and bumps the version,
+so other processes drop their cached copy on their next read.
+"""
+from sqlalchemy.sql import select, literal
+
+import tracker_database as database
+from fitnessapp import versions
+from fitnessapp.extensions import db
+from fitnessapp.models import TagClosure
+from fitnessapp.cache import LRUCache
+
+# user_id -> (version, tags)
+_tags = LRUCache(maxsize=1024, ttl=5*60)
+
+def get_tags(user_id):
+    """ Return a dictionary mapping IDs to serialized tags for all of the user's tags. """
+    user_id = int(user_id)
+    version = versions.get_version('tags', user_id)
+    cached = _tags.get(user_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    tags = db.session.query(database.Tag) \
+            .filter_by(user_id=user_id) \
+            .all()
+    tags = dict([(t.id, t.to_dict()) for t in tags])
+    _tags.set(user_id, (version, tags))
+    return tags
+
+def tag_exists(user_id, tag_id):
+    """ Check in the database, rather than the cache, whether the user has a tag with the given ID. """
+    return db.session.query(database.Tag.id) \
+            .filter_by(id=tag_id) \
+            .filter_by(user_id=int(user_id)) \
+            .first() is not None
+
+def invalidate(user_id):
+    _tags.pop(int(user_id))
+
+def search_tags(user_id, query, limit=5):
+    """ Return up to `limit` of the user's tags containing the query string (case-insensitive). """
+    query = query.lower()
+    results = []
+    for tag in get_tags(user_id).values():
+        if query in (tag['tag'] or '').lower():
+            results.append(tag)
+            if len(results) >= limit:
+                break
+    return results
+
+def add_to_closure(tag):
+    """ Add the closure table rows for a newly-created tag. Does not commit. """
+    table = TagClosure.__table__
+    db.session.execute(
+        table.insert().values(ancestor_id=tag.id, descendant_id=tag.id, depth=0)
+    )
+    if tag.parent_id is not None:
+        db.session.execute(
+            table.insert().from_select(['ancestor_id', 'descendant_id', 'depth'],
+                select([
+                    table.c.ancestor_id,
+                    literal(tag.id),
+                    table.c.depth+1
+                ]).where(table.c.descendant_id == tag.parent_id)
+            )
+        )
+
+def get_descendant_ids(tag_id):
+    """ Return the IDs of the given tag and all of its descendants. """
+    table = TagClosure.__table__
+    rows = db.session.execute(
+        select([table.c.descendant_id]).where(table.c.ancestor_id == tag_id)
+    )
+    return [r[0] for r in rows]
+
+def rebuild_closure(user_id=None):
+    """ Recompute the closure table from the tags' `parent_id`s. Does not commit. """
+    table = TagClosure.__table__
+    query = db.session.query(database.Tag) \
+            .with_entities(
+                    database.Tag.id,
+                    database.Tag.parent_id
+            )
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    parents = dict(query.all())
+    db.session.execute(
+        table.delete().where(table.c.descendant_id.in_(list(parents.keys())))
+    )
+    rows = []
+    for tag_id in parents:
+        ancestor_id = tag_id
+        depth = 0
+        visited = set()
+        while ancestor_id is not None and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': tag_id, 'depth': depth})
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    if len(rows) > 0:
+        db.session.execute(table.insert(), rows)
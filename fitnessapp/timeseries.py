@@ -0,0 +1,75 @@
+""" Downsampling of time series for charts.
+
+All functions take arrays of timestamps `x` (sorted in ascending order) and
+values `y`, and return a pair of arrays with at most `n` points.
+"""
+import numpy as np
+
+def _bucket_indices(x, n):
+    """ Assign each point to one of `n` buckets of equal width in `x`. """
+    if x[-1] == x[0]:
+        return np.zeros(len(x), dtype=int)
+    edges = np.linspace(x[0], x[-1], n+1)
+    return np.clip(np.searchsorted(edges, x, side='right')-1, 0, n-1)
+
+def bucket_mean(x, y, n):
+    """ Average the points in each of `n` equal-width buckets. Empty buckets are dropped. """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= n:
+        return x, y
+    buckets = _bucket_indices(x, n)
+    counts = np.bincount(buckets, minlength=n)
+    nonempty = counts > 0
+    mean_x = np.bincount(buckets, weights=x, minlength=n)[nonempty]/counts[nonempty]
+    mean_y = np.bincount(buckets, weights=y, minlength=n)[nonempty]/counts[nonempty]
+    return mean_x, mean_y
+
+def bucket_min_max(x, y, n):
+    """ Keep the lowest and highest point in each of `n//2` equal-width buckets, so that extremes are preserved. """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= n:
+        return x, y
+    buckets = _bucket_indices(x, max(n//2, 1))
+    # Sort by bucket, then by value. The first point of each bucket is its minimum and the last is its maximum.
+    order = np.lexsort((y, buckets))
+    sorted_buckets = buckets[order]
+    first = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+    last = np.r_[first[1:]-1, len(order)-1]
+    keep = np.unique(np.concatenate([order[first], order[last]]))
+    return x[keep], y[keep]
+
+def lttb(x, y, n):
+    """ Largest-Triangle-Three-Buckets downsampling.
+    Keeps the first and last points, and from each bucket in between, the point forming the largest triangle with the previously selected point and the average of the next bucket.
+    See Steinarsson, "Downsampling Time Series for Visual Representation" (2013).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= n or n < 3:
+        return x, y
+    # Bucket boundaries over the points between the first and last.
+    edges = np.linspace(1, len(x)-1, n-1).astype(int)
+    selected = np.empty(n, dtype=int)
+    selected[0] = 0
+    selected[-1] = len(x)-1
+    a = 0
+    for i in range(n-2):
+        start, end = edges[i], edges[i+1]
+        next_start, next_end = edges[i+1], (edges[i+2] if i+2 < len(edges) else len(x))
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs(
+            (x[a]-avg_x)*(y[start:end]-y[a]) -
+            (x[a]-x[start:end])*(avg_y-y[a])
+        )
+        a = start+int(np.argmax(areas))
+        selected[i+1] = a
+    return x[selected], y[selected]
+
+methods = {
+    'lttb': lttb,
+    'mean': bucket_mean,
+    'minmax': bucket_min_max
+}
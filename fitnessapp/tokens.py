@@ -0,0 +1,78 @@
+""" Signed, expiring bearer tokens for API clients.
+
+A token contains the user's ID, the version of their credentials at the time
+it was issued (see `fitnessapp.versions`), and a unique token ID. Requests
+sending `Authorization: Bearer <token>` are authenticated from the token
+alone, without loading the session or the `User` row.
+
+All of a user's tokens are revoked by bumping their 'user' version, which
+happens whenever their password changes. Individual tokens can be revoked
+through the denylist, which is kept in memory and so only applies to the
+worker process that handled the revocation.
+"""
+import threading
+import time
+import uuid
+
+from flask import current_app as app
+from flask_login import UserMixin
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+from fitnessapp import versions
+
+# jti -> time at which the token expires
+_denylist = {}
+_lock = threading.Lock()
+
+class TokenUser(UserMixin):
+    """ The user authenticated by a bearer token. Only the ID is available. """
+    def __init__(self, user_id, jti):
+        self.id = user_id
+        self.jti = jti
+
+def _serializer():
+    return URLSafeTimedSerializer(app.secret_key, salt='api-token')
+
+def _max_age():
+    return app.config.get('API_TOKEN_MAX_AGE', 60*60*24*7)
+
+def issue_token(user_id):
+    """ Return a new token for the given user. """
+    user_id = int(user_id)
+    return _serializer().dumps({
+        'uid': user_id,
+        'pv': versions.get_version('user', user_id),
+        'jti': uuid.uuid4().hex
+    })
+
+def load_token(token):
+    """ Return a `TokenUser` for a valid token, or `None` if it is malformed, expired or revoked. """
+    try:
+        payload = _serializer().loads(token, max_age=_max_age())
+        user_id = int(payload['uid'])
+        version = payload['pv']
+        jti = payload['jti']
+    except (BadSignature, SignatureExpired, KeyError, TypeError, ValueError):
+        return None
+    with _lock:
+        if jti in _denylist:
+            return None
+    current_version = versions.get_version('user', user_id,
+            max_age=app.config.get('API_TOKEN_VERSION_MAX_AGE', 30))
+    if version != current_version:
+        return None
+    return TokenUser(user_id, jti)
+
+def revoke(user):
+    """ Revoke the token a `TokenUser` was loaded from. """
+    # The token is no longer accepted after `_max_age()` seconds from now at the latest
+    now = time.time()
+    expires = now+_max_age()
+    with _lock:
+        for jti in [k for k,v in _denylist.items() if v < now]:
+            del _denylist[jti]
+        _denylist[user.jti] = expires
+
+def revoke_all(user_id):
+    """ Revoke every token issued to a user. Does not commit. """
+    versions.bump_version('user', user_id)
@@ -0,0 +1,176 @@
+""" Lightweight tracing.
+
+A sampled fraction of requests (`TRACE_SAMPLE_RATE`) record a span for the
+request itself and for every `span` or `traced` function called while
+handling it, including each SQL statement. Finished spans are kept in a ring
+buffer of the most recent `TRACE_BUFFER_SIZE` spans, which can be exported
+from the local-only `/traces` endpoint as JSON, or in the Chrome trace event
+format (`?format=chrome`) for chrome://tracing or Perfetto.
+
+Outside of a sampled request, `span` does nothing, so it is cheap to leave in
+hot paths.
+"""
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from fitnessapp import metrics
+
+_local = threading.local()
+_buffer = deque(maxlen=10000)
+_lock = threading.Lock()
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def start_trace(name, **attrs):
+    """ Start a new trace with a root span. Returns the span, which must be passed to `end_span`. """
+    _local.trace_id = uuid.uuid4().hex
+    _local.stack = []
+    return start_span(name, **attrs)
+
+def start_span(name, **attrs):
+    """ Start a span as a child of the current one. Returns `None` if no trace is being recorded. """
+    if getattr(_local, 'trace_id', None) is None:
+        return None
+    stack = _stack()
+    span = {
+        'trace_id': _local.trace_id,
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': stack[-1]['span_id'] if len(stack) > 0 else None,
+        'name': name,
+        'start': time.time(),
+        'duration': None,
+        'pid': os.getpid(),
+        'thread': threading.get_ident(),
+        'attrs': attrs
+    }
+    span['_start'] = time.perf_counter()
+    stack.append(span)
+    return span
+
+def end_span(span, error=None):
+    if span is None:
+        return
+    span['duration'] = time.perf_counter()-span.pop('_start')
+    if error is not None:
+        span['attrs']['error'] = repr(error)
+    stack = _stack()
+    if span in stack:
+        # Anything started after this span and not ended is closed along with it
+        del stack[stack.index(span):]
+    if len(stack) == 0:
+        _local.trace_id = None
+    with _lock:
+        _buffer.append(span)
+
+@contextmanager
+def span(name, **attrs):
+    """ Record the enclosed block as a span. The span's `attrs` dictionary can be updated inside the block. """
+    s = start_span(name, **attrs)
+    try:
+        yield s
+    except BaseException as e:
+        end_span(s, error=e)
+        raise
+    end_span(s)
+
+def traced(name=None):
+    """ Decorator recording each call of a function as a span. Can be used as `@traced` or `@traced('name')`. """
+    def decorator(f):
+        span_name = name if isinstance(name, str) else '%s.%s' % (f.__module__, f.__qualname__)
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'trace_id', None) is None:
+                return f(*args, **kwargs)
+            with span(span_name):
+                return f(*args, **kwargs)
+        return wrapper
+    if callable(name):
+        return decorator(name)
+    return decorator
+
+def get_spans(trace_id=None):
+    with _lock:
+        spans = list(_buffer)
+    if trace_id is not None:
+        spans = [s for s in spans if s['trace_id'] == trace_id]
+    return spans
+
+def to_chrome_trace(spans):
+    """ Convert spans to the Chrome trace event format. Times are in microseconds. """
+    return {
+        'traceEvents': [{
+            'name': s['name'],
+            'cat': s['name'].split('.')[0],
+            'ph': 'X',
+            'ts': s['start']*1e6,
+            'dur': s['duration']*1e6,
+            'pid': s['pid'],
+            'tid': s['thread'],
+            'args': dict(s['attrs'], trace_id=s['trace_id'])
+        } for s in spans],
+        'displayTimeUnit': 'ms'
+    }
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    s = start_span('sql', statement=statement[:200])
+    conn.info.setdefault('trace_spans', []).append(s)
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    end_span(conn.info['trace_spans'].pop())
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    spans = context.connection.info.get('trace_spans') if context.connection is not None else None
+    if spans:
+        end_span(spans.pop(), error=context.original_exception)
+
+@metrics.local_only
+def traces_endpoint():
+    """ Recorded spans as JSON, or in the Chrome trace format with `?format=chrome`. Filter with `?trace_id=`. """
+    spans = get_spans(request.args.get('trace_id'))
+    if request.args.get('format') == 'chrome':
+        output = to_chrome_trace(spans)
+    else:
+        output = {'pid': os.getpid(), 'spans': spans}
+    return json.dumps(output), 200, {'Content-Type': 'application/json'}
+
+def init_app(app):
+    global _buffer
+    _buffer = deque(maxlen=app.config.get('TRACE_BUFFER_SIZE', 10000))
+    sample_rate = app.config.get('TRACE_SAMPLE_RATE', 0.01)
+
+    @app.before_request
+    def _start_request_trace():
+        _local.trace_id = None
+        if random.random() < sample_rate:
+            _local.request_span = start_trace('request', method=request.method, path=request.path)
+        else:
+            _local.request_span = None
+
+    @app.teardown_request
+    def _end_request_trace(error=None):
+        s = getattr(_local, 'request_span', None)
+        _local.request_span = None
+        if s is not None:
+            if request.url_rule is not None:
+                s['name'] = 'request %s %s' % (request.method, request.url_rule.rule)
+            end_span(s, error=error)
+        _local.trace_id = None
+
+    app.add_url_rule('/traces', 'traces', traces_endpoint)
@@ -0,0 +1,135 @@
+""" Cached lookups of users and user profiles.
+
+Lookups are memoized on `flask.g` for the duration of a request, and kept in
+a bounded TTL cache across requests. Anything that modifies a `User` or
+`UserProfile` must call `invalidate_user`. Other worker processes only see the
+change once their copy expires.
+"""
+from flask import g, has_request_context
+
+from tracker_database import User, UserProfile
+from fitnessapp.extensions import db
+from fitnessapp.cache import LRUCache
+
+_users = LRUCache(maxsize=1024, ttl=60)
+_profiles = LRUCache(maxsize=1024, ttl=60)
+
+def _request_memo():
+    if not has_request_context():
+        return {}
+    if 'user_cache' not in g:
+        g.user_cache = {}
+    return g.user_cache
+
+def profile_to_dict(profile):
+    return {
+        'id': profile.id,
+        'display_name': profile.display_name,
+        'gender': profile.gender,
+        'last_activity': profile.last_activity,
+
+        'prefered_units': profile.prefered_units,
+
+        'target_weight': profile.target_weight,
+        'target_calories': profile.target_calories,
+        'weight_goal': profile.weight_goal,
+
+        'country': profile.country,
+        'state': profile.state,
+        'city': profile.city
+    }
+
+def get_user(user_id):
+    """ Return the `User` with the given ID, or `None`.
+    The returned object is detached from the session, so it must not be modified.
+    """
+    user_id = int(user_id)
+    memo = _request_memo()
+    key = ('user', user_id)
+    if key in memo:
+        return memo[key]
+    user = _users.get(user_id)
+    if user is None:
+        user = db.session.query(User) \
+                .filter_by(id=user_id) \
+                .first()
+        if user is not None:
+            db.session.expunge(user)
+            _users.set(user_id, user)
+    memo[key] = user
+    return user
+
+def get_profile(user_id):
+    """ Return a dictionary containing the profile of the user with the given ID, or `None`. """
+    user_id = int(user_id)
+    memo = _request_memo()
+    key = ('profile', user_id)
+    if key in memo:
+        return memo[key]
+    profile = _profiles.get(user_id)
+    if profile is None:
+        profile = db.session.query(UserProfile) \
+                .filter_by(id=user_id) \
+                .first()
+        if profile is not None:
+            profile = profile_to_dict(profile)
+            _profiles.set(user_id, profile)
+    memo[key] = profile
+    return profile
+
+def get_profiles(user_ids):
+    """ Return a dictionary mapping user IDs to profile dictionaries. IDs with no profile are left out.
+    Profiles that are not cached are loaded in a single query.
+    """
+    memo = _request_memo()
+    results = {}
+    missing = []
+    for user_id in set(int(i) for i in user_ids):
+        key = ('profile', user_id)
+        if key in memo:
+            profile = memo[key]
+        else:
+            profile = _profiles.get(user_id)
+            if profile is None:
+                missing.append(user_id)
+                continue
+        if profile is not None:
+            results[user_id] = profile
+    if len(missing) > 0:
+        profiles = db.session.query(UserProfile) \
+                .filter(UserProfile.id.in_(missing)) \
+                .all()
+        for profile in profiles:
+            results[profile.id] = profile_to_dict(profile)
+            _profiles.set(profile.id, results[profile.id])
+        for user_id in missing:
+            memo[('profile', user_id)] = results.get(user_id)
+    for user_id, profile in results.items():
+        memo[('profile', user_id)] = profile
+    return results
+
+def get_prefered_units(user_id, cached=True):
+    """ Return the user's prefered units.
+    With `cached=False`, they are read from the database. Use this when converting weights that are written, and for responses whose ETag or cache key must not be paired with another process's stale copy.
+    """
+    if cached:
+        profile = get_profile(user_id)
+    else:
+        profile = db.session.query(UserProfile) \
+                .with_entities(UserProfile.prefered_units) \
+                .filter_by(id=int(user_id)) \
+                .first()
+        if profile is not None:
+            profile = {'prefered_units': profile.prefered_units}
+    if profile is None:
+        raise Exception('No profile found for user %s.' % user_id)
+    return profile['prefered_units']
+
+def invalidate_user(user_id):
+    """ Remove a user and their profile from the cache. """
+    user_id = int(user_id)
+    _users.pop(user_id)
+    _profiles.pop(user_id)
+    memo = _request_memo()
+    memo.pop(('user', user_id), None)
+    memo.pop(('profile', user_id), None)
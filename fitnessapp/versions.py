@@ -0,0 +1,88 @@
+""" Version counters for entity types, used to answer conditional requests.
+
+Write paths call `bump_version` in the same transaction as the change. Read
+endpoints build an ETag from `get_version` and can return 304 Not Modified
+without running any other queries.
+"""
+import hashlib
+import time
+
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from fitnessapp.cache import LRUCache
+from fitnessapp.extensions import db
+from fitnessapp.models import EntityVersion
+
+GLOBAL = 0
+
+# (entity, user_id) -> (version, time at which it was read from the database)
+# Only consulted when a caller passes `max_age`, so the TTL just needs to exceed the largest one in use.
+_local_versions = LRUCache(maxsize=4096, ttl=5*60)
+
+def get_version(entity, user_id=GLOBAL, max_age=0):
+    """ Return the current version of an entity type.
+    If `max_age` is given, a version read by this process less than `max_age` seconds ago is returned without querying the database. Changes made by other processes may then take up to `max_age` seconds to be seen.
+    """
+    key = (entity, int(user_id))
+    now = time.monotonic()
+    if max_age > 0:
+        cached = _local_versions.get(key)
+        if cached is not None and now-cached[1] < max_age:
+            return cached[0]
+    version = db.session.query(EntityVersion) \
+            .with_entities(EntityVersion.version) \
+            .filter_by(user_id=key[1]) \
+            .filter_by(entity=entity) \
+            .scalar()
+    if version is None:
+        version = 0
+    _local_versions.set(key, (version, now))
+    return version
+
+def bump_version(entity, user_id=GLOBAL):
+    """ Increment the version of an entity type. Must be called in the same transaction as the change. Does not commit. """
+    table = EntityVersion.__table__
+    user_id = int(user_id)
+    statement = insert(table) \
+            .values(user_id=user_id, entity=entity, version=1) \
+            .on_conflict_do_update(
+                    index_elements=[table.c.user_id, table.c.entity],
+                    set_={'version': table.c.version+1}
+            )
+    db.session.execute(statement)
+    # Forget the local copy once the transaction ends (see below)
+    db.session.info.setdefault('bumped_versions', set()).add((entity, user_id))
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_bumped_versions(session, *args):
+    bumped = session.info.pop('bumped_versions', [])
+    for key in bumped:
+        _local_versions.pop(key)
+
+def make_etag(entity, version, user_id=GLOBAL, extra=None):
+    etag = '%s-%s-%s' % (entity, user_id, version)
+    if extra is not None:
+        etag += '-%s' % extra
+    return etag
+
+def query_key():
+    """ A short hash of the request's query string, for the ETags of endpoints whose output depends on it. """
+    return hashlib.sha1(request.query_string).hexdigest()[:12]
+
+def not_modified(etag):
+    """ Return a 304 response if the request's `If-None-Match` header matches the ETag, or `None` otherwise. """
+    # Compressed responses carry a weak version of the ETag (see `fitnessapp.compression`)
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={'ETag': '"%s"' % etag})
+    return None
+
+def etag_headers(etag):
+    """ Headers to send along with a response that can be revalidated with the given ETag. """
+    return {
+        'ETag': '"%s"' % etag,
+        'Cache-Control': 'private, no-cache'
+    }
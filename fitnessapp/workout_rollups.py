@@ -0,0 +1,77 @@
+""" Per-user, per-exercise, per-day workout rollups.
+
+Workout set write paths call `refresh_rollups` with the (exercise_id, date)
+pairs they touched, in the same transaction as the change. Each refresh only
+aggregates the sets for that one exercise on that one day, so progression
+charts can be served with a range query over the rollups instead of a scan of
+the user's whole history.
+"""
+from sqlalchemy.sql import func, select
+
+from tracker_database import WorkoutSet
+from fitnessapp.extensions import db
+from fitnessapp.models import ExerciseDailyRollup
+
+def _rollup_select():
+    return select([
+                WorkoutSet.user_id,
+                WorkoutSet.exercise_id,
+                WorkoutSet.date,
+                func.count(WorkoutSet.id),
+                func.coalesce(func.sum(WorkoutSet.reps), 0),
+                func.coalesce(func.sum(WorkoutSet.duration), 0),
+                func.max(WorkoutSet.reps),
+                func.max(WorkoutSet.duration)
+            ]) \
+            .where(WorkoutSet.exercise_id.isnot(None)) \
+            .group_by(
+                    WorkoutSet.user_id,
+                    WorkoutSet.exercise_id,
+                    WorkoutSet.date
+            )
+
+_rollup_columns = ['user_id', 'exercise_id', 'date', 'sets', 'reps', 'duration', 'best_reps', 'best_duration']
+
+def refresh_rollups(user_id, keys):
+    """ Recompute the rollups for the given (exercise_id, date) pairs. Does not commit. """
+    table = ExerciseDailyRollup.__table__
+    for exercise_id, date in set(keys):
+        if exercise_id is None or date is None:
+            continue
+        db.session.execute(
+            table.delete() \
+                .where(table.c.user_id == user_id) \
+                .where(table.c.exercise_id == exercise_id) \
+                .where(table.c.date == date)
+        )
+        db.session.execute(
+            table.insert().from_select(_rollup_columns,
+                _rollup_select() \
+                    .where(WorkoutSet.user_id == user_id) \
+                    .where(WorkoutSet.exercise_id == exercise_id) \
+                    .where(WorkoutSet.date == date)
+            )
+        )
+
+def rebuild_rollups(user_id=None):
+    """ Recompute all rollups, or all of one user's rollups, from the raw workout sets. Does not commit. """
+    table = ExerciseDailyRollup.__table__
+    delete = table.delete()
+    query = _rollup_select()
+    if user_id is not None:
+        delete = delete.where(table.c.user_id == user_id)
+        query = query.where(WorkoutSet.user_id == user_id)
+    db.session.execute(delete)
+    db.session.execute(table.insert().from_select(_rollup_columns, query))
+
+def get_rollups(user_id, exercise_id, start_date=None, end_date=None):
+    query = db.session.query(ExerciseDailyRollup) \
+            .filter_by(user_id=user_id) \
+            .filter_by(exercise_id=exercise_id)
+    if start_date is not None:
+        query = query.filter(ExerciseDailyRollup.date >= start_date)
+    if end_date is not None:
+        query = query.filter(ExerciseDailyRollup.date <= end_date)
+    return query \
+            .order_by(ExerciseDailyRollup.date) \
+            .all()